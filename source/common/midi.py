@@ -7,8 +7,10 @@
  permission of Brian R. Gunnison
 """
 import time
+import heapq
 import threading
 import logging
+from collections import deque
 
 try:
     import rtmidi
@@ -17,19 +19,43 @@ except:
     exit(0)
 
 from rtmidi.midiconstants import *
+from common.timing import make_ticker, set_thread_realtime, HybridWaiter, ClockPll, CLOCK_BACKENDS, NS_PER_SEC
+from common.midi_messages import (pack_message, message_from_list, message_to_list, message_length, SYSTEM_MESSAGE_LENGTHS,
+                                  message_status, message_type, message_channel, message_note, message_velocity,
+                                  message_is_note_on, message_is_note_off, note_off_message,
+                                  NOTE_OFF_MESSAGES, note_on_rows, note_on_row, note_message, RunningStatusEncoder,
+                                  VoiceAllocator, VOICE_STEALING, VOICE_GENERATED, VOICE_PLAYED)
 
 logging.basicConfig(level=logging.ERROR)
 log = logging.getLogger(__name__)
 
 BPM_MIN = 10
 BPM_MAX = 300 # also in the kv slider file
+CLOCKS_PER_BEAT = 24 # midi clocks per quarter note
+PULSES_PER_TICK = 40 # fine time between clocks for scheduling notes, clock out stays at 24
+PPQN = CLOCKS_PER_BEAT * PULSES_PER_TICK # 960 pulses per quarter note
+# clock bus subscribers are called every division ticks
+DIVISION_TICK = 1
+DIVISION_SIXTEENTH = 6
+DIVISION_BEAT = CLOCKS_PER_BEAT
+DIVISION_BAR = 4 * CLOCKS_PER_BEAT # 4/4
+# when clock work overruns a tick: run missed ticks back to back, fold them into one callback, or skip their work
+OVERLOAD_POLICIES = ['burst', 'coalesce', 'drop']
+
+def bpm_to_tick_ns(bpm):
+    """
+    nanoseconds between midi clocks at this bpm
+    """
+    return round((60 * NS_PER_SEC) / (bpm * CLOCKS_PER_BEAT))
+
+CC_MAX = 127
 
 class MidiConstants:
     """
     exported outside this file as well as here
     """
     def __init__(self):
-        self.CC_MAX = 127
+        self.CC_MAX = CC_MAX
 
 
 class MidiPort:
@@ -119,6 +145,9 @@ class MidiPort:
 
         #self.midi.set_error_callback(self.error_callback) not necessary
 
+    def is_port_open(self):
+        return self.midi.is_port_open()
+
     def close_port(self):
         if self.midi.is_port_open() == True:
             self.midi.close_port() # safely removes callback for midiin
@@ -131,6 +160,119 @@ class MidiPort:
 
 gstart_debug_timer = 0.0
 
+class MidiTimebase:
+    """
+    the one musical tick count, owned by MidiManager so it outlives switching clock sources.
+    A stopping source hands over where it got to and the next one carries on counting from there,
+    so note manager events keep their place. If the old source was still ticking the new one
+    also keeps its phase, otherwise it starts its ticks from now.
+    """
+    def __init__(self):
+        self.tick = 0
+        self.tick_ns = time.perf_counter_ns()
+        self.period_ns = bpm_to_tick_ns(BPM_MIN)
+        self.handoffs = 0
+
+    def hand_off(self, clock):
+        self.tick, self.tick_ns = clock.tick_and_time()
+        self.period_ns = clock.get_tick_period_ns()
+
+    def take_over(self):
+        """
+        returns the tick to carry on from and when it happened
+        """
+        self.handoffs += 1
+        now = time.perf_counter_ns()
+        if now - self.tick_ns >= self.period_ns:
+            return self.tick, now # stalled, no phase to keep
+
+        return self.tick, self.tick_ns
+
+
+class ClockSubscription:
+    """
+    returned by ClockBus.subscribe, pass it back to unsubscribe
+    """
+    __slots__ = ('callback', 'data', 'division', 'phase', 'idle_callback', 'next_tick', 'active')
+
+    def __init__(self, callback, data, division, phase, idle_callback):
+        self.callback = callback
+        self.data = data
+        self.division = division
+        self.phase = phase % division
+        self.idle_callback = idle_callback
+        self.next_tick = 0
+        self.active = True
+
+    def next_boundary(self, tick):
+        """
+        first tick after this one that is on our division and phase
+        """
+        return tick + self.division - ((tick - self.phase) % self.division)
+
+
+class ClockBus:
+    """
+    shares one clock between subscribers, each called only on its own boundaries,
+    ticks where (tick - phase) % division == 0. A heap keyed on each subscriber's
+    next tick means a tick costs nothing for those not due.
+    The clock source calls dispatch as its clock callback and is_idle as its idle callback.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = [] # (next tick, seq, subscription)
+        self.seq = 0
+        self.tick = 0 # last tick dispatched
+        self.subscriptions = []
+
+    def subscribe(self, callback, data=None, division=DIVISION_TICK, phase=0, idle_callback=None):
+        """
+        callback(tick, data, skipped) where skipped is how many of our boundaries were folded into this call
+        idle_callback returns True when the subscriber has nothing to do, None means it always has
+        """
+        subscription = ClockSubscription(callback, data, division, phase, idle_callback)
+        with self.lock:
+            self.subscriptions.append(subscription)
+            self.push(subscription, subscription.next_boundary(self.tick))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        # its heap entry is dropped when it comes up
+        with self.lock:
+            subscription.active = False
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def push(self, subscription, tick):
+        subscription.next_tick = tick
+        heapq.heappush(self.heap, (tick, self.seq, subscription))
+        self.seq += 1
+
+    def dispatch(self, tick, data=None, skipped=0):
+        due = []
+        with self.lock:
+            self.tick = tick
+            while self.heap and self.heap[0][0] <= tick:
+                next_tick, seq, subscription = heapq.heappop(self.heap)
+                if subscription.active == False:
+                    continue
+
+                # boundaries passed while ticks were skipped or the count jumped come together
+                folded = (tick - next_tick) // subscription.division
+                due.append((subscription, folded))
+                self.push(subscription, subscription.next_boundary(tick))
+
+        for subscription, folded in due:
+            subscription.callback(tick, subscription.data, folded)
+
+    def is_idle(self):
+        for subscription in self.subscriptions:
+            if subscription.idle_callback is None or subscription.idle_callback() == False:
+                return False
+
+        return True
+
+
 class MidiClockSource:
     """
     base class for a clock source either external or internal
@@ -138,8 +280,17 @@ class MidiClockSource:
     def __init__(self):
         self.bpm = BPM_MIN 
         self.clock_callback = None
+        self.idle_callback = None
         self.tick = 0
+        self.tick_ns = time.perf_counter_ns() # when the current tick came in
+        self.tick_seq = 0 # odd while tick and tick_ns are being written, see set_tick
+        self.timebase = None # shared with other sources, see MidiTimebase
+        self.due_ns = None # set by a clock that knows when its tick was due
+        self.fine_timing = False # true if the callback may wait between ticks for pulses
         self.midiout = None
+        self.overload_policy = 'burst' # what to do when ticks are missed, one of OVERLOAD_POLICIES
+        self.overruns = 0   # times work took longer than a tick
+        self.skipped_ticks = 0 # ticks that did not get their own callback
 
     def get_bpm(self):
         if self.bpm < BPM_MIN:
@@ -158,30 +309,143 @@ class MidiClockSource:
     def send_clock_out(self, midiout):
         self.midiout = midiout
 
-    def register_clock_callback(self, callback, data=None):
+    def register_clock_callback(self, callback, data=None, idle_callback=None):
+        """
+        idle_callback returns True when there is nothing scheduled,
+        a tickless clock can then sleep until wake is called
+        """
         self.clock_callback = callback
         self.clock_data = data
-        self.tick = 1
+        self.idle_callback = idle_callback
+        if self.timebase is None:
+            self.set_tick(1, time.perf_counter_ns())
+        else:
+            self.set_tick(*self.timebase.take_over())
         self.clock_delta_time = 0.0
 
+    def set_timebase(self, timebase):
+        self.timebase = timebase
+
     def start_clock(self):
         pass # override
     
     def stop_clock(self):
         self.clock_callback = None
         self.clock_data = None
+        self.wake()
+        if self.timebase is not None:
+            self.timebase.hand_off(self)
         #log.info('stopping clock')
 
     def get_tick(self):
-        return self.tick
+        return self.tick_and_time()[0]
+
+    def tick_and_time(self):
+        """
+        the current tick and the perf_counter_ns it came in at, read again if the clock
+        thread wrote them in between so a new tick never gets the old tick's time
+        """
+        while True:
+            seq = self.tick_seq
+            tick = self.tick
+            tick_ns = self.tick_ns
+            if seq & 1 == 0 and seq == self.tick_seq:
+                return tick, tick_ns
+            time.sleep(0) # let the writer finish
+
+    def set_tick(self, tick, tick_ns):
+        """
+        only the clock thread ticks, the sequence lets tick_and_time see a torn pair
+        """
+        self.tick_seq += 1
+        self.tick = tick
+        self.tick_ns = tick_ns
+        self.tick_seq += 1
+
+    def get_tick_period_ns(self):
+        return bpm_to_tick_ns(self.get_bpm())
+
+    def get_time(self, pulses_per_tick=PULSES_PER_TICK):
+        """
+        the clock in pulses, interpolated from the time since the last tick.
+        Stops short of the next tick so time never runs backwards when it comes in
+        """
+        tick, tick_ns = self.tick_and_time()
+        pulse = ((time.perf_counter_ns() - tick_ns) * pulses_per_tick) // self.get_tick_period_ns()
+        if pulse >= pulses_per_tick:
+            pulse = pulses_per_tick - 1
+        elif pulse < 0:
+            pulse = 0
+
+        return (tick * pulses_per_tick) + pulse
+
+    def pulse_to_ns(self, pulse, pulses_per_tick=PULSES_PER_TICK):
+        """
+        perf_counter_ns when a pulse is expected at the current tempo
+        """
+        tick, tick_ns = self.tick_and_time()
+        return tick_ns + (((pulse - (tick * pulses_per_tick)) * self.get_tick_period_ns()) // pulses_per_tick)
+
+    def wake(self):
+        pass # override, something was scheduled
+
+    def set_overload_policy(self, policy):
+        if policy not in OVERLOAD_POLICIES:
+            log.error(f'Unknown clock overload policy {policy}')
+            return
+
+        self.overload_policy = policy
+
+    def get_overload_stats(self):
+        return {'policy': self.overload_policy,
+                'overruns': self.overruns,
+                'skipped_ticks': self.skipped_ticks}
+
+    def process_ticks(self, ticks):
+        """
+        plays the ticks that came due, more than one means work overran a tick
+        clocks always go out so downstream tempo holds, the policy decides what the callback gets
+        """
+        if ticks <= 1:
+            self.process_tick()
+            return
 
-    def process_tick(self):
+        missed = ticks - 1
+        self.overruns += 1
+        if self.overload_policy == 'burst':
+            for t in range(ticks):
+                self.process_tick()
+            return
+
+        if self.overload_policy == 'coalesce':
+            self.skipped_ticks += missed
+            self.process_tick(skipped=missed)
+            return
+
+        # drop, the late ticks get no work at all
+        self.skipped_ticks += ticks
+        self.send_clocks(ticks)
+        self.stamp_tick(self.tick + ticks)
+
+    def stamp_tick(self, tick):
+        if self.due_ns is None:
+            self.set_tick(tick, time.perf_counter_ns())
+        else:
+            self.set_tick(tick, self.due_ns)
+
+    def send_clocks(self, count):
         if self.midiout is not None:
-            self.midiout.send_clock_message() 
+            self.midiout.send_at(0, count) # a MidiClockOut
 
-        self.tick += 1           # number of clock msgs since inception
+    def process_tick(self, skipped=0):
+        """
+        skipped is the number of ticks coalesced into this one
+        """
+        self.send_clocks(skipped + 1)
+
+        self.stamp_tick(self.tick + skipped + 1) # number of clock msgs since inception
         if self.clock_callback is not None:
-            self.clock_callback(self.tick, self.clock_data)
+            self.clock_callback(self.tick, self.clock_data, skipped)
         else:
             log.error('Clock callback is None')
 
@@ -203,7 +467,24 @@ class MidiInternalClock(MidiClockSource):
         self.cc_controls = cc_controls
         # 24 beats per quarter note, (60/60)/24 = 41.6 msec
         self.tick_time = (60.0/self.bpm)/24.0
+        # same thing in integer nanoseconds, the clock thread schedules off this
+        self.tick_period_ns = bpm_to_tick_ns(self.bpm)
         self.time_alarm = False # gets set if we run out of time between ticks
+        # how the clock thread waits for a tick, one of CLOCK_BACKENDS
+        self.backend = self.settings.get('ClockBackend', 'hybrid')
+        # hybrid sleeps then spins to each deadline, spin cpu is limited to this percent of the wait
+        self.spin_budget = self.settings.get('ClockSpinBudget', 10)/100.0
+        self.set_overload_policy(self.settings.get('ClockOverloadPolicy', 'coalesce'))
+        self.ticker = None
+        self.generation = 0 # bumped on every start so an old thread knows to exit
+        # with nothing scheduled and no clock out the thread blocks instead of ticking
+        self.tickless = self.settings.get('TicklessIdle', True)
+        self.wake_event = threading.Event()
+        self.idling = False
+        self.idle_tick = 0
+        self.idle_since_ns = 0
+        self.fine_timing = True # our own thread, waiting in it for a pulse delays no input
+        self.clock_out_tick = 0 # clocks are queued up to this tick
         if self.cc_controls is not None:
             self.cc_controls.add(name='InternalClockBPMControlCC',
                                  cc_default=28, # must be unique to effect CCs
@@ -220,54 +501,165 @@ class MidiInternalClock(MidiClockSource):
 
         self.bpm = bpm
         self.tick_time = (60.0/self.bpm)/24.0
+        # the clock thread sees the new period and re-anchors at the tick it last played
+        self.tick_period_ns = bpm_to_tick_ns(self.bpm)
+        self.wake()
         #log.info(f'internal bpm: {bpm}')
         self.settings.set('internal_clock_bpm', self.bpm)
 
-    def callback(self):
+    def tick_and_time(self):
+        if self.idling:
+            # the thread is blocked, work out where it would be
+            ticks = (time.perf_counter_ns() - self.idle_since_ns) // self.tick_period_ns
+            return self.idle_tick + ticks, self.idle_since_ns + (ticks * self.tick_period_ns)
+
+        return super().tick_and_time()
+
+    def get_tick_period_ns(self):
+        return self.tick_period_ns
+
+    def wake(self):
+        self.wake_event.set()
+
+    def is_idle(self):
+        if self.tickless == False or self.idle_callback is None:
+            return False
+
+        if self.midiout is not None and self.midiout.is_port_open():
+            return False # clock out has to keep going
+
+        return self.idle_callback()
+
+    def idle(self, ticker, generation):
+        """
+        block until something is scheduled, then catch the tick count up
+        """
+        self.idle_tick = self.tick
+        self.idle_since_ns = ticker.last_deadline_ns()
+        self.wake_event.clear()
+        self.idling = True
+        while self.clock_callback is not None and generation == self.generation and \
+              self.tick_period_ns == ticker.period_ns and self.is_idle():
+            if self.wake_event.wait(1.0):
+                break
+
+        ticks = ticker.resync() # no callbacks for the ticks we slept through
+        self.set_tick(self.tick + ticks, ticker.last_deadline_ns())
+        self.clock_out_tick = self.tick # idle means no clock out, nothing to catch up
+        self.idling = False
+
+    def send_clocks(self, count):
+        """
+        clocks are queued on the clock out thread a tick ahead, so however long
+        our callbacks take the next clock still goes out on its deadline
+        """
+        if self.midiout is None:
+            return
+
+        tick = self.tick + count # where these clocks take us
+        while self.clock_out_tick <= tick:
+            self.clock_out_tick += 1
+            # ones already due go now, the next at its deadline on our grid
+            self.midiout.send_at(self.due_ns + ((self.clock_out_tick - tick) * self.tick_period_ns))
+
+    def set_backend(self, backend):
+        """
+        takes effect next time the clock starts
+        """
+        if backend not in CLOCK_BACKENDS:
+            log.error(f'Unknown clock backend {backend}')
+            return
+
+        self.backend = backend
+        self.settings.set('ClockBackend', self.backend)
+
+    def callback(self, generation):
+        """
+        Tick N fires at anchor + N * period, deadlines are absolute so
+        sleep overshoot is absorbed by the next wait instead of adding up.
+        """
+        set_thread_realtime('Clock', self.settings)
+        period = self.tick_period_ns
+        ticker = make_ticker(self.backend, self.spin_budget)
+        self.ticker = ticker
+        self.clock_out_tick = self.tick
+        if time.perf_counter_ns() - self.tick_ns < period:
+            # took over from a running clock, stay on its grid
+            ticker.start(period, self.tick_ns)
+            ticks = ticker.wait()
+        else:
+            ticker.start(period)
+            ticks = 1
         while True:
-            if self.clock_callback is None:
+            if self.clock_callback is None or generation != self.generation:
+                ticker.stop()
                 log.info('Exiting internal clock thread')
                 return # exit thread
 
-            start = time.perf_counter()
+            self.due_ns = ticker.last_deadline_ns() # so time between ticks interpolates off the grid
+            self.process_ticks(ticks)
+
+            if self.tick_period_ns != period:
+                # bpm changed, new phase starts at the deadline of the tick just played
+                period = self.tick_period_ns
+                ticker.set_period(period)
+
+            if self.is_idle():
+                self.idle(ticker, generation)
 
-            self.process_tick()
-            
-            time_to_sleep = self.tick_time - (time.perf_counter() - start) # subtract off time we worked
            # log.info(f'Internal clock tick: {self.tick}')
-            if time_to_sleep <= 0.0:
+            ticks = ticker.wait()
+            if ticks > 1:
+                # late, the overload policy gets us back on the grid
                 self.time_alarm = True
                 log.error('Internal clock work took too long')
-                time.sleep(self.tick_time) # gotta sleep else we get stuck here
-            else:
-                time.sleep(time_to_sleep)
 
     def start_clock(self):
         if self.clock_callback is None:
             return
-        log.info(f"Starting internal clock: {self.tick_time:.03f}")
-        timerThread = threading.Thread(target=self.callback)
+        log.info(f"Starting internal clock: {self.tick_time:.03f}, {self.backend}")
+        self.generation += 1
+        self.wake() # an old thread may be idle
+        timerThread = threading.Thread(target=self.callback, args=(self.generation,))
         timerThread.start()
 
 
 
 class MidiInput(MidiPort, MidiClockSource):
-    def __init__(self, q_size_limit=1024):
+    def __init__(self, settings=None, q_size_limit=1024):
         MidiPort.__init__(self)
         MidiClockSource.__init__(self)
         self.midi = rtmidi.MidiIn(queue_size_limit=q_size_limit)
+        self.settings = settings
+        self.callback_thread = None # rtmidi calls us from its own thread, set its priority once
         
         self.note_callback = None
         self.clock = None   # clock source
         self.control_callback = None
         self.control_data = None
-        # need to average the delta time if external clock comes in here so to display a non-jerky BPM
-        self.ext_clock_update_period = 0.5 # update every half second for UI
+        # external clock tempo and phase come from a pll on the clock timestamps
+        self.pll = ClockPll()
+        self.ext_clock_update_period = 0.5 # update bpm every half second for UI
         self.last_ext_clock_time = time.perf_counter()
-        self.last_ext_tick_update = self.tick
-        self.rave_order = 6
-        self.rave_samples = []
-        self.rave_sum = 0
+        # rtmidi delta times are between any two messages, summed they are rtmidi's own timeline
+        self.rt_time_ns = 0
+        self.rt_offset_ns = None # perf_counter_ns minus rtmidi time, from the least delayed message
+        # clock out from a clean grid instead of forwarding ticks as they arrive
+        self.regenerate = False
+        self.regenerate_delay_ns = 0
+        if self.settings is not None and self.settings.get('ClockRegenerate', False) == True:
+            self.regenerate = True
+            self.regenerate_delay_ns = self.settings.get('ClockRegenerateDelayMs', 3) * NS_PER_SEC // 1000
+        # if F8 stops for this long, or 1.5 ticks if that is longer, we freewheel at the pll tempo
+        self.loss_timeout_ns = 100 * NS_PER_SEC // 1000
+        if self.settings is not None:
+            self.loss_timeout_ns = self.settings.get('ClockLossTimeoutMs', 100) * NS_PER_SEC // 1000
+        self.clock_lock = threading.Lock() # F8 and the freewheel thread both tick
+        self.clock_generation = 0 # bumped on every start so an old watchdog knows to exit
+        self.last_clock_ns = 0
+        self.freewheeling = False
+        self.clock_events = deque(maxlen=CLOCK_EVENTS_KEPT) # (time.time(), event, tick) for diagnostics
+        self.losses = 0
 
     def register_note_callback(self, callback):
         self.note_callback = callback
@@ -282,46 +674,76 @@ class MidiInput(MidiPort, MidiClockSource):
     def calc_ext_clock_bpm(self):
         """
         This runs every clock tick, so we are only interested in updated the UI approx.
+        the pll has already filtered the tempo
         """
         now = time.perf_counter()
         tp = now - self.last_ext_clock_time
-        if tp < self.ext_clock_update_period:
+        if tp < self.ext_clock_update_period or self.pll.period_ns <= 0:
             return
 
         self.last_ext_clock_time = now
-        ticks = self.tick - self.last_ext_tick_update
-        self.last_ext_tick_update = self.tick
+        self.bpm = round((60 * NS_PER_SEC) / (CLOCKS_PER_BEAT * self.pll.period_ns))
 
-        # so now we know how many ticks passed in .5 seconds
+        #log.info(f'bpm: {self.bpm}')
 
-        clock_delta_time = self.ext_clock_update_period/float(ticks)
-        if len(self.rave_samples) == self.rave_order:
-            self.rave_sum -= self.rave_samples.pop(0)
+    def message_time_ns(self, delta_time):
+        """
+        when rtmidi says the message came in, as perf_counter_ns.
+        The smallest offset between our clock and rtmidi's is the message that waited least,
+        it creeps up a little each message so drift between the clocks is followed
+        """
+        now = time.perf_counter_ns()
+        self.rt_time_ns += round(delta_time * NS_PER_SEC)
+        offset = now - self.rt_time_ns
+        if self.rt_offset_ns is None or offset < self.rt_offset_ns:
+            self.rt_offset_ns = offset
+        else:
+            self.rt_offset_ns += RT_OFFSET_CREEP_NS
 
-        self.rave_sum += clock_delta_time
-        self.rave_samples.append(clock_delta_time)
-        ave_delta_time = self.rave_sum/float(len(self.rave_samples))
+        return self.rt_time_ns + self.rt_offset_ns
 
-        # to get bpm from an external clock we use the delta time
-        # self.tick_time = (60.0/self.bpm)/24.0
-        # since it is not too accurate we average it
-        self.bpm = round(60/(24 * ave_delta_time))
+    def get_tick_period_ns(self):
+        if self.pll.period_ns > 0:
+            return self.pll.period_ns
+        return super().get_tick_period_ns()
 
-        #log.info(f'bpm: {self.bpm}')
+    def get_pll_stats(self):
+        return self.pll.get_stats()
 
+    def send_clocks(self, count):
+        if self.midiout is None:
+            return
+
+        if self.regenerate == False or self.due_ns is None:
+            self.midiout.send_at(0, count) # as they arrive
+            return
+
+        # sent on the filtered grid, arrival jitter under the delay is gone
+        self.midiout.send_at(self.due_ns + self.regenerate_delay_ns, count)
 
 
     def callback(self, msg_dt, data):
         global gstart_debug_timer
+        if self.callback_thread != threading.get_ident():
+            self.callback_thread = threading.get_ident()
+            set_thread_realtime('MIDI in', self.settings)
+
         message = msg_dt[0]
         data0 = message[0]
         data_type = message[0] & 0xF0 # now we accept all channels
+        # msg_dt[1] is the time since the last message of any kind
+        arrival_ns = self.message_time_ns(msg_dt[1])
 
         if self.clock_callback is not None:
             if data0 == TIMING_CLOCK: # F8
-                #msg_dt[1] is supposed to be time between clocks, but inaccurate
                 #log.info(f'external clock tick: {self.tick}')
-                self.process_tick()
+                with self.clock_lock:
+                    self.last_clock_ns = arrival_ns
+                    if self.freewheeling:
+                        self.end_freewheel(arrival_ns)
+                    else:
+                        self.due_ns = self.pll.update(arrival_ns) # ticks are stamped with the filtered time
+                    self.process_tick()
 
                 # all this so we can display external clock rate on UI
                 self.calc_ext_clock_bpm()
@@ -333,7 +755,9 @@ class MidiInput(MidiPort, MidiClockSource):
                 gstart_debug_timer = time.perf_counter()
                 
                 #log.info(f"{self.port_name} - Note In: {message}")
-                self.note_callback(message, self.clock)
+                self.note_callback(note_message(data0, message[1], message[2]), self.clock) # packed, see pack_message
+                if self.clock is not None:
+                    self.clock.wake() # a tickless clock has work now
                 if self.midi_activity_callback is not None:
                     self.midi_activity_callback()
                 return
@@ -348,68 +772,326 @@ class MidiInput(MidiPort, MidiClockSource):
     def start_clock(self):
         super(MidiInput, self).start_clock()
         self.midi.ignore_types(timing = False) # don't ignore MIDI clock messages
-        self.rave_samples = []
-        self.rave_sum = 0
+        self.pll.reset()
+        self.due_ns = None
+        self.freewheeling = False
+        self.last_clock_ns = time.perf_counter_ns()
+        if self.clock_callback is not None:
+            self.clock_generation += 1
+            watchdog = threading.Thread(target=self.watchdog, args=(self.clock_generation,), daemon=True)
+            watchdog.start()
         log.info(f'Midiin set as clock source')
 
 
     def stop_clock(self):
+        self.clock_generation += 1
         super(MidiInput, self).stop_clock()
         self.midi.ignore_types(timing = True)
         log.info(f'Midiin ignoring clock')
 
+    def record_clock_event(self, event):
+        self.clock_events.append((time.time(), event, self.tick))
+        log.info(f'External clock {event} at tick {self.tick}')
+
+    def get_clock_events(self):
+        return list(self.clock_events)
+
+    def clock_lost_in(self, now):
+        """
+        nanoseconds until we call the external clock lost, 0 or less if it is
+        """
+        timeout = max(self.loss_timeout_ns, (3 * self.pll.period_ns) // 2)
+        return self.last_clock_ns + timeout - now
+
+    def end_freewheel(self, arrival_ns):
+        """
+        F8 is back, the count carries on from where we freewheeled to.
+        Close to our phase the pll pulls in smoothly, otherwise take theirs
+        """
+        self.freewheeling = False
+        if abs(arrival_ns - self.pll.next_tick_ns()) > self.pll.period_ns // 2:
+            self.due_ns = self.pll.relock(arrival_ns)
+        else:
+            self.due_ns = self.pll.update(arrival_ns)
+        self.record_clock_event('relock')
+
+    def watchdog(self, generation):
+        """
+        watches for the external clock stopping and stands in for it until it comes back,
+        so scheduled notes still play and end
+        """
+        set_thread_realtime('Clock watchdog', self.settings)
+        waiter = HybridWaiter()
+        while generation == self.clock_generation and self.clock_callback is not None:
+            if self.freewheeling == False:
+                lost_in = self.clock_lost_in(time.perf_counter_ns())
+                if self.pll.period_ns <= 0:
+                    lost_in = self.loss_timeout_ns # no tempo yet to freewheel at, look again later
+                if lost_in > 0:
+                    time.sleep(lost_in / NS_PER_SEC)
+                    continue
+
+                with self.clock_lock:
+                    if self.clock_lost_in(time.perf_counter_ns()) <= 0:
+                        self.freewheeling = True
+                        self.losses += 1
+                        self.record_clock_event('lost')
+                continue
+
+            # missed ticks since the last F8 come out straight away, then on the grid
+            waiter.wait_until(self.pll.next_tick_ns())
+            with self.clock_lock:
+                if self.freewheeling == False or generation != self.clock_generation or self.clock_callback is None:
+                    continue
+                self.due_ns = self.pll.freewheel()
+                self.process_tick()
+
     def run(self):
         self.midi.set_callback(self.callback)
         self.remember_midin_callback(self.callback) # reregister if port is changed
 
 
 
+class OutputBudget:
+    """
+    token bucket on the bytes we send a port, 5 pin DIN runs at 31250 baud, 3125 bytes a second.
+    Over budget clock still goes straight out, note offs wait ahead of everything else
+    and note ons and the rest wait behind them, sent by our own thread as the budget allows.
+    If the wait would go over max_delay the quietest waiting note ons are shed,
+    echoes fade as they go so they are shed first. The output forgets a shed note
+    and drops its note off when it comes.
+    """
+    def __init__(self, output, bytes_per_sec, max_delay_ms=20, burst_bytes=32):
+        self.output = output # MidiOutput, we call its write
+        self.rate = bytes_per_sec
+        self.burst = burst_bytes # bucket size, what can go back to back
+        self.max_queued = burst_bytes + (bytes_per_sec * max_delay_ms) // 1000
+        self.tokens = float(burst_bytes)
+        self.refill_ns = time.perf_counter_ns()
+        self.cond = threading.Condition()
+        self.offs = deque()
+        self.others = deque()
+        self.queued_bytes = 0
+        self.running = False
+        self.sent_bytes = 0
+        self.deferred = 0 # messages that had to wait
+        self.shed = 0 # note ons dropped, and later their note off
+
+    def refill(self):
+        now = time.perf_counter_ns()
+        self.tokens = min(self.burst, self.tokens + ((now - self.refill_ns) * self.rate) / NS_PER_SEC)
+        self.refill_ns = now
+
+    def take(self, size):
+        """
+        for clock, it goes now whatever the budget says
+        """
+        with self.cond:
+            self.refill()
+            self.tokens -= size
+            self.sent_bytes += size
+
+    def submit(self, message):
+        with self.cond:
+            self.refill()
+            size = message_length(message)
+            if not self.offs and not self.others and self.tokens >= size:
+                self.tokens -= size
+                self.sent_bytes += size
+                self.output.write(message)
+                return
+
+            data_type = (message >> 16) & 0xF0
+            if data_type == NOTE_OFF or (data_type == NOTE_ON and message & 0x7F == 0):
+                if self.drop_waiting_note_on(message):
+                    return # never sounded so no off needed
+                self.offs.append(message)
+            else:
+                self.others.append(message)
+
+            self.queued_bytes += size
+            self.deferred += 1
+            self.shed_overload()
+            if self.running == False:
+                self.running = True
+                threading.Thread(target=self.drain, daemon=True).start()
+            self.cond.notify()
+
+    def drop_waiting_note_on(self, off):
+        on = ((off >> 8) & 0x0F7F) | (NOTE_ON << 8) # status and note of its note on
+        for i in range(len(self.others) - 1, -1, -1):
+            message = self.others[i]
+            if message >> 8 == on and message & 0x7F > 0:
+                del self.others[i]
+                self.queued_bytes -= 3
+                self.shed += 1
+                return True
+        return False
+
+    def shed_overload(self):
+        while self.queued_bytes > self.max_queued:
+            quietest = None
+            for i, message in enumerate(self.others):
+                if (message >> 16) & 0xF0 == NOTE_ON and (quietest is None or message & 0x7F < self.others[quietest] & 0x7F):
+                    quietest = i
+
+            if quietest is None:
+                return # only offs and controls left, they all go
+
+            self.queued_bytes -= 3
+            message = self.others[quietest]
+            del self.others[quietest]
+            self.shed += 1
+            self.output.note_shed(message)
+
+    def drain(self):
+        while True:
+            with self.cond:
+                while not self.offs and not self.others:
+                    self.cond.wait()
+
+                self.refill()
+                queue = self.offs if self.offs else self.others
+                size = message_length(queue[0])
+                if self.tokens >= size:
+                    message = queue.popleft()
+                    self.tokens -= size
+                    self.queued_bytes -= size
+                    self.sent_bytes += size
+                    self.output.write(message)
+                    continue
+
+                wait = (size - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def clear(self):
+        """
+        drops all but the note offs
+        """
+        with self.cond:
+            for message in self.others:
+                self.queued_bytes -= message_length(message)
+            self.others.clear()
+
+    def get_stats(self):
+        return {'byte_rate': self.rate,
+                'sent_bytes': self.sent_bytes,
+                'queued_bytes': self.queued_bytes,
+                'deferred': self.deferred,
+                'shed': self.shed}
+
+
 class MidiOutput(MidiPort):
     def __init__(self):
         super().__init__()
         self.midi = rtmidi.MidiOut()
-        self.notes_pending = 0
+        # note ons sent without their off yet, per channel and note, index is channel << 7 | note
+        self.active_notes = bytearray(16 * 128)
+        self.notes_pending = 0 # sounding notes, the count of the above
+        self.notes_lock = threading.Lock() # clock, dispatcher and input threads all send
+        self.shed_notes = bytearray(16 * 128) # note offs to drop, their note on was shed by the budget
+        self.shed_pending = 0 # the count of the above
+        self.budget = None # OutputBudget if the port is rate limited
+        self.encoder = None # RunningStatusEncoder if set
+        self.voices = None # VoiceAllocator if polyphony is limited
+
+    def set_voice_limit(self, max_voices, max_per_channel=0, stealing='priority'):
+        """
+        0 for both is no limit
+        """
+        if max_voices <= 0 and max_per_channel <= 0:
+            self.voices = None
+            return
+
+        self.voices = VoiceAllocator(max_voices, max_per_channel, stealing)
+
+    def get_voice_stats(self):
+        if self.voices is None:
+            return None
+        return self.voices.get_stats()
+
+    def set_running_status(self, enable):
+        self.encoder = RunningStatusEncoder() if enable else None
+
+    def get_encoder_stats(self):
+        if self.encoder is None:
+            return None
+        return self.encoder.get_stats()
+
+    def set_byte_rate(self, bytes_per_sec, max_delay_ms=20):
+        """
+        0 means no limit, 3125 is what a 5 pin DIN cable carries
+        """
+        if bytes_per_sec <= 0:
+            self.budget = None
+            return
+
+        self.budget = OutputBudget(self, bytes_per_sec, max_delay_ms)
+
+    def get_budget_stats(self):
+        if self.budget is None:
+            return None
+        return self.budget.get_stats()
 
     def get_notes_pending(self):
-        # not a reliable method to see if any stuck notes...
         return self.notes_pending
 
-    def panic(self):
+    def is_note_sounding(self, channel, note):
+        return self.active_notes[(channel << 7) | note] > 0
+
+    def panic(self, reset=False):
+        """
+        note offs for just the notes we left on, in one go without waiting.
+        See PanicScheduler for one paced for slow devices
+        """
+        for message in self.panic_messages(reset):
+            if self.budget is not None:
+                self.budget.submit(message) # paced by its thread, not here
+            else:
+                self.write(message)
+
+    def panic_messages(self, reset=False):
+        """
+        forgets the notes we left on and returns their note offs.
+        reset adds all sound off, all notes off and reset all controllers on every channel,
+        for notes some other device left on
+        """
         if self.midi.is_port_open() == False:
-            return
+            return []
 
-        self.notes_pending = 0
         log.info(f"Panic")
-        for channel in range(16):
-            data = CONTROL_CHANGE + channel
-            try:
-                self.midi.send_message([data, ALL_SOUND_OFF, 0])
-            except:
-                log.error('Cant panic is port open?')
-                return
-
-            #self.midi.send_message([data, RESET_ALL_CONTROLLERS, 0])
-            time.sleep(0.05)
+        if self.budget is not None:
+            self.budget.clear() # waiting note ons never play, waiting note offs still go
+        if self.voices is not None:
+            self.voices.reset()
+
+        with self.notes_lock:
+            active_notes = self.active_notes
+            self.active_notes = bytearray(16 * 128)
+            self.notes_pending = 0
+            self.shed_notes = bytearray(16 * 128)
+            self.shed_pending = 0
+
+        messages = [NOTE_OFF_MESSAGES[index] for index, count in enumerate(active_notes) if count]
+        if reset:
+            for channel in range(16):
+                messages.append(pack_message(CONTROL_CHANGE + channel, ALL_SOUND_OFF))
+                messages.append(pack_message(CONTROL_CHANGE + channel, ALL_NOTES_OFF))
+                messages.append(pack_message(CONTROL_CHANGE + channel, RESET_ALL_CONTROLLERS))
+        return messages
 
     def purge(self):
-        self.notes_pending = 0
+        pass # active_notes is exact, nothing to forget
 
-    def send_message(self, message):
+    def send_message(self, message, priority=VOICE_GENERATED):
+        """
+        priority is for voice stealing, VOICE_PLAYED for notes the player played
+        """
         if self.midi.is_port_open() == False:
             return
 
-        #log.info(f"{self.port_name} - Note out: {message}")
-        data_type = message[0] & 0xF0 # all channels
-        if data_type == NOTE_OFF:
-            self.notes_pending -= 1
-        if data_type == NOTE_ON:
-            self.notes_pending += 1
-
-        #log.info(f'notes pending: {self.notes_pending}')
-        try:
-            self.midi.send_message(message)
-        except:
-            log.error('Cant send midi message, port closed?')
+        self.send(message, priority)
 
         time_passed = time.perf_counter() - gstart_debug_timer
         #log.info(f'tp: {time_passed:.04f}')
@@ -417,16 +1099,412 @@ class MidiOutput(MidiPort):
         if self.midi_activity_callback is not None:
             self.midi_activity_callback()
 
+    def send_messages(self, messages, priority=VOICE_GENERATED):
+        """
+        a batch due at the same time, in the order given
+        """
+        if self.midi.is_port_open() == False:
+            return
+
+        for message in messages:
+            self.send(message, priority)
+
+        if self.midi_activity_callback is not None:
+            self.midi_activity_callback()
+
+    def send(self, message, priority=VOICE_GENERATED):
+        #log.info(f"{self.port_name} - Note out: {message}")
+        if self.shed_pending > 0 and self.drop_shed_note_off(message):
+            return
+
+        if self.voices is not None:
+            for out in self.voices.process(message, priority):
+                self.emit(out)
+            return
+
+        self.emit(message)
+
+    def emit(self, message):
+        data_type = (message >> 16) & 0xF0 # all channels
+        if data_type == NOTE_ON or data_type == NOTE_OFF:
+            index = ((message >> 9) & 0x0780) | ((message >> 8) & 0x7F) # channel << 7 | note
+            with self.notes_lock:
+                if data_type == NOTE_ON and message & 0x7F > 0:
+                    if self.active_notes[index] == 0:
+                        self.notes_pending += 1
+                    if self.active_notes[index] < 255:
+                        self.active_notes[index] += 1
+                elif self.active_notes[index] > 0:
+                    self.active_notes[index] -= 1
+                    if self.active_notes[index] == 0:
+                        self.notes_pending -= 1
+
+        #log.info(f'notes pending: {self.notes_pending}')
+        if self.budget is not None:
+            self.budget.submit(message)
+            return
+
+        self.write(message)
+
+    def note_shed(self, message):
+        """
+        the budget dropped a note on we had already counted, so it never sounded.
+        Uncount it, free its voice and drop the note off that comes for it later
+        """
+        index = ((message >> 9) & 0x0780) | ((message >> 8) & 0x7F) # channel << 7 | note
+        with self.notes_lock:
+            if self.active_notes[index] > 0:
+                self.active_notes[index] -= 1
+                if self.active_notes[index] == 0:
+                    self.notes_pending -= 1
+            if self.shed_notes[index] < 255:
+                self.shed_notes[index] += 1
+                self.shed_pending += 1
+
+        if self.voices is not None:
+            self.voices.release(index >> 7, index & 0x7F)
+
+    def drop_shed_note_off(self, message):
+        data_type = (message >> 16) & 0xF0
+        if data_type != NOTE_OFF and (data_type != NOTE_ON or message & 0x7F > 0):
+            return False
+
+        index = ((message >> 9) & 0x0780) | ((message >> 8) & 0x7F)
+        with self.notes_lock:
+            if self.shed_notes[index] == 0:
+                return False
+            self.shed_notes[index] -= 1
+            self.shed_pending -= 1
+        return True
+
+    def write(self, message):
+        encoder = self.encoder
+        if encoder is not None:
+            # held until it is sent so the port gets messages in the order the encoder saw them
+            with encoder.lock:
+                message = encoder.update(message)
+                if message is not None:
+                    self.send_to_port(message)
+            return
+
+        self.send_to_port(message)
+
+    def send_to_port(self, message):
+        try:
+            self.midi.send_message(message_to_list(message))
+        except:
+            log.error('Cant send midi message, port closed?')
+
 
     def send_clock_message(self):
         if self.midi.is_port_open() == False:
             return
+        if self.budget is not None:
+            self.budget.take(1) # clock never waits
         try:
             self.midi.send_message([TIMING_CLOCK])
         except:
             log.error('Cant send clock, port closed?') # devices can be powered off
 
 
+DISPATCH_SLEEP_NS = 2000000 # closer than this to a deadline the waiter takes over from the condition
+CLOCK_EVENTS_KEPT = 100 # external clock loss and relock history
+CLOCK_MESSAGE = TIMING_CLOCK << 16
+RT_OFFSET_CREEP_NS = 1000 # per message, follows up to 1000ppm of drift at 1000 messages a second
+
+class MidiDispatcher:
+    """
+    rtmidi has no timestamped send, so schedulers hand us messages a little
+    ahead with an absolute perf_counter_ns deadline and our own thread sends
+    them right on it. Lateness is the actual send time minus the deadline.
+    """
+    def __init__(self, midiout, settings=None, name='Dispatcher'):
+        self.midiout = midiout
+        self.settings = settings # only for thread priority
+        self.name = name
+        self.heap = [] # [deadline_ns, seq, messages], seq keeps same deadline batches in order
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.waiter = HybridWaiter()
+        self.running = False
+        self.sent = 0
+        self.late_count = 0 # batches more than a msec late
+        self.late_total_ns = 0
+        self.max_late_ns = 0
+        self.batches = 0
+        self.batch_deadline_ns = 0 # of what is being sent right now
+
+    def start(self):
+        if self.running:
+            return
+
+        self.running = True
+        # does not hold up app exit, nothing here outlives the port anyway
+        thread = threading.Thread(target=self.thread, daemon=True)
+        thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.heap = []
+            self.cond.notify()
+
+    def send_at(self, deadline_ns, messages):
+        """
+        messages go out together, in order, at deadline_ns or straight away if it has passed
+        """
+        with self.cond:
+            entry = [deadline_ns, self.seq, messages]
+            self.seq += 1
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.cond.notify() # earlier than what the thread is waiting for
+
+    def cancel_note(self, channel, note):
+        """
+        drop pending note ons for channel and note. Its pending note offs go out now instead,
+        whoever queued them counted them as sent and a note on of theirs may be sounding
+        """
+        key = (channel << 8) | note
+        offs = []
+        with self.cond:
+            for entry in self.heap:
+                kept = []
+                for m in entry[2]:
+                    if (m >> 16) & 0xE0 != NOTE_OFF or (m >> 8) & 0x0F7F != key:
+                        kept.append(m)
+                    elif (m >> 16) & 0xF0 == NOTE_OFF or m & 0x7F == 0:
+                        offs.append(m)
+                entry[2] = kept
+
+        if offs:
+            self.midiout.send_messages(offs)
+
+    def purge(self):
+        with self.cond:
+            self.heap = []
+
+    def next_batch(self):
+        """
+        blocks until the first deadline is close, returns it or None when stopped
+        """
+        with self.cond:
+            while self.running:
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+
+                wait_ns = self.heap[0][0] - time.perf_counter_ns()
+                if wait_ns <= DISPATCH_SLEEP_NS:
+                    return self.heap[0][0]
+
+                # anything earlier sent in the meantime notifies us
+                self.cond.wait((wait_ns - DISPATCH_SLEEP_NS) / NS_PER_SEC)
+
+        return None
+
+    def thread(self):
+        set_thread_realtime(self.name, self.settings)
+        while True:
+            deadline = self.next_batch()
+            if deadline is None:
+                return # exit thread
+
+            now = self.waiter.wait_until(deadline)
+            messages = []
+            with self.cond:
+                while self.heap and self.heap[0][0] <= now:
+                    entry = heapq.heappop(self.heap)
+                    messages.extend(entry[2])
+                    if entry[0] < deadline:
+                        deadline = entry[0]
+
+            if not messages:
+                continue # cancelled
+
+            late_ns = time.perf_counter_ns() - deadline # the earliest in the batch is the latest
+            self.batch_deadline_ns = deadline
+            self.midiout.send_messages(messages)
+            self.sent += len(messages)
+            self.batches += 1
+            self.late_total_ns += late_ns
+            if late_ns > self.max_late_ns:
+                self.max_late_ns = late_ns
+            if late_ns > NS_PER_SEC // 1000:
+                self.late_count += 1
+
+    def get_stats(self):
+        late_mean_ns = 0
+        if self.batches > 0:
+            late_mean_ns = self.late_total_ns // self.batches
+
+        return {'sent': self.sent,
+                'late_mean_ns': late_mean_ns,
+                'max_late_ns': self.max_late_ns,
+                'late_count': self.late_count,
+                'pending': len(self.heap)}
+
+
+class MidiClockOut:
+    """
+    clock out on its own thread with its own deadlines, to any number of ports.
+    Clock sources queue clocks with send_at, so however long effect callbacks
+    take on the clock thread the clocks already queued go out on time.
+    Lateness against the deadline is kept per port, later ports in the list are later.
+    """
+    def __init__(self, settings=None):
+        self.ports = []
+        self.port_stats = {} # port: stats dict, see get_stats
+        self.lock = threading.Lock()
+        self.dispatcher = MidiDispatcher(self, settings, name='Clock out')
+
+    def start(self):
+        self.dispatcher.start()
+
+    def stop(self):
+        self.dispatcher.stop()
+
+    def add_port(self, midiout):
+        with self.lock:
+            if midiout in self.ports:
+                return
+            self.ports = self.ports + [midiout] # copied so sending never sees it change
+            self.port_stats[midiout] = {'sent': 0, 'late_ns': 0, 'max_late_ns': 0, 'jitter_ns': 0}
+
+    def remove_port(self, midiout):
+        with self.lock:
+            self.ports = [port for port in self.ports if port is not midiout]
+            self.port_stats.pop(midiout, None)
+
+    def is_port_open(self):
+        for port in self.ports:
+            if port.is_port_open():
+                return True
+        return False
+
+    def send_at(self, deadline_ns, count=1):
+        """
+        count clocks at deadline_ns, 0 or any time gone means now
+        """
+        if deadline_ns <= 0:
+            deadline_ns = time.perf_counter_ns()
+        self.dispatcher.send_at(deadline_ns, [CLOCK_MESSAGE] * count)
+
+    def send_messages(self, messages):
+        """
+        called on the clock out thread by the dispatcher
+        """
+        deadline = self.dispatcher.batch_deadline_ns
+        for port in self.ports:
+            if port.is_port_open() == False:
+                continue
+
+            for message in messages:
+                port.send_clock_message()
+
+            stats = self.port_stats.get(port)
+            if stats is None:
+                continue # removed while we sent
+
+            late = time.perf_counter_ns() - deadline
+            stats['sent'] += len(messages)
+            if late > stats['max_late_ns']:
+                stats['max_late_ns'] = late
+            # jitter is how much the lateness varies, averaged like the hybrid waiter does overshoot
+            stats['jitter_ns'] += (abs(late - stats['late_ns']) - stats['jitter_ns']) // 8
+            stats['late_ns'] += (late - stats['late_ns']) // 8
+
+    def get_stats(self):
+        """
+        per port name: clocks sent, running average and max lateness, and jitter, all in ns
+        """
+        return {port.port_name: dict(stats) for port, stats in self.port_stats.items()}
+
+
+class PanicScheduler:
+    """
+    panic without blocking whoever asked, usually the UI thread. The messages are queued
+    on our dispatcher spaced at a rate the device can take and the callbacks are called,
+    on the dispatcher thread, once the last has gone.
+    A panic while one is going on adds to it, the notes sent since and a reset if asked,
+    so hitting the button repeatedly still makes one sequence.
+    """
+    def __init__(self, midiout, settings=None):
+        self.midiout = midiout
+        rate = 1000
+        if settings is not None:
+            rate = settings.get('PanicMessagesPerSec', 1000) # 3000 bytes a second, just under DIN
+        self.gap_ns = NS_PER_SEC // rate
+        self.lock = threading.Lock()
+        self.dispatcher = MidiDispatcher(self, settings, name='Panic')
+        self.remaining = 0 # messages queued and not yet sent
+        self.reset = False # the queued sequence has a reset in it
+        self.next_ns = 0 # when the next message added can go
+        self.callbacks = []
+        self.panics = 0
+        self.merged = 0
+
+    def start(self):
+        self.dispatcher.start()
+
+    def stop(self):
+        self.dispatcher.stop()
+
+    def is_busy(self):
+        return self.remaining > 0
+
+    def panic(self, reset=False, callback=None):
+        """
+        returns straight away, callback() when done
+        """
+        with self.lock:
+            if self.remaining > 0:
+                self.merged += 1
+                reset = reset and self.reset == False
+            else:
+                self.panics += 1
+                self.reset = False
+                self.next_ns = time.perf_counter_ns()
+
+            messages = self.midiout.panic_messages(reset)
+            self.reset = self.reset or reset
+            if callback is not None:
+                self.callbacks.append(callback)
+
+            if self.remaining == 0 and not messages:
+                callbacks = self.callbacks
+                self.callbacks = []
+            else:
+                callbacks = []
+                self.remaining += len(messages)
+                for message in messages:
+                    self.dispatcher.send_at(self.next_ns, [message])
+                    self.next_ns += self.gap_ns
+
+        for callback in callbacks:
+            callback() # nothing to send
+
+    def send_messages(self, messages):
+        """
+        called on our thread by the dispatcher
+        """
+        self.midiout.send_messages(messages)
+        with self.lock:
+            self.remaining -= len(messages)
+            if self.remaining > 0:
+                return
+
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        for callback in callbacks:
+            callback()
+
+    def get_stats(self):
+        return {'panics': self.panics,
+                'merged': self.merged,
+                'pending': self.remaining}
+
 
 class MidiManager():
     """
@@ -435,20 +1513,42 @@ class MidiManager():
 
     def __init__(self, settings, use_clock=True):
         self.settings = settings
-        self.midiin = MidiInput()
+        self.midiin = MidiInput(settings)
         self.midiout = MidiOutput()
+        # 0 is unlimited, for a 5 pin DIN link 3125
+        self.midiout.set_byte_rate(self.settings.get('OutputByteRate', 0), self.settings.get('OutputMaxDelayMs', 20))
+        self.midiout.set_running_status(self.settings.get('OutputRunningStatus', False))
+        # 0 no limit, most synths have 8 to 16 voices
+        self.midiout.set_voice_limit(self.settings.get('MaxVoices', 0), self.settings.get('MaxVoicesPerChannel', 0),
+                                     self.settings.get('VoiceStealing', 'priority'))
+        # clock out has its own thread, to midiout and any extra ports
+        self.clock_out = MidiClockOut(settings)
+        self.clock_out.add_port(self.midiout)
+        self.clock_out_ports = {} # name: MidiOutput for the extra ones
+        self.clock_out.start()
+        self.panic_scheduler = PanicScheduler(self.midiout, settings)
+        self.panic_scheduler.start()
         self.cc_controls = CCControls(settings, self.midiin)
         self.internal_clock = None
-        self.clock_callback = None
+        self.clock_bus = ClockBus() # every clock source calls this, effects subscribe to it
+        self.clock_callback = self.clock_bus.dispatch
         self.clock_data = None
+        self.idle_callback = self.clock_bus.is_idle
         self.clock = None # clock object
         self.clock_source = None
+        self.timebase = MidiTimebase() # tick count carries across clock source changes
+        self.midiin.set_timebase(self.timebase)
         if use_clock:
             # clock stuff
             self.internal_clock = MidiInternalClock(self.settings, cc_controls=self.cc_controls)
+            self.internal_clock.set_timebase(self.timebase)
             self.clock_source = self.settings.get('ClockSource', 'internal')
             self.set_clock_source(self.clock_source)
 
+        # after the clock, adding one wakes it
+        for name in self.settings.get('ClockOutPorts', []):
+            self.add_clock_out_port(name)
+
 
     def get_midi_in_ports(self):
         try:
@@ -482,8 +1582,53 @@ class MidiManager():
             self.midiout.open_port(name)
         except:
             return False
+
+        if self.clock is not None:
+            self.clock.wake() # clock out has to run now
         return True
 
+    def add_clock_out_port(self, name):
+        """
+        clock out also goes to this port
+        """
+        if name in self.clock_out_ports:
+            return True
+
+        port = MidiOutput()
+        try:
+            port.open_port(name)
+        except:
+            log.error(f'Cannot open clock out port {name}')
+            return False
+
+        self.clock_out_ports[name] = port
+        self.clock_out.add_port(port)
+        self.settings.set('ClockOutPorts', list(self.clock_out_ports.keys()))
+        if self.clock is not None:
+            self.clock.wake() # clock out has to run now
+        return True
+
+    def remove_clock_out_port(self, name):
+        port = self.clock_out_ports.pop(name, None)
+        if port is None:
+            return
+
+        self.clock_out.remove_port(port)
+        port.close_port()
+        self.settings.set('ClockOutPorts', list(self.clock_out_ports.keys()))
+
+    def get_clock_out_stats(self):
+        return self.clock_out.get_stats()
+
+    def get_output_budget_stats(self):
+        return self.midiout.get_budget_stats()
+
+    def get_output_encoder_stats(self):
+        return self.midiout.get_encoder_stats()
+
+    def get_voice_stats(self):
+        return self.midiout.get_voice_stats()
+
     def close_midi_out_port(self):
         try:
             self.midiout.close_port()
@@ -512,8 +1657,8 @@ class MidiManager():
         if clock_source == 'external':
             self.clock = self.midiin
 
-        self.clock.register_clock_callback(callback=self.clock_callback, data=self.clock_data)  
-        self.clock.send_clock_out(self.midiout) # might make option...
+        self.clock.register_clock_callback(callback=self.clock_callback, data=self.clock_data, idle_callback=self.idle_callback)
+        self.clock.send_clock_out(self.clock_out) # might make option...
         # pass clock so we know when notes arrive
         self.midiin.set_clock_source(self.clock)
         self.clock.start_clock()
@@ -532,22 +1677,30 @@ class MidiManager():
         # pass clock so we know when notes arrive
         self.midiin.set_clock_source(self.clock)
 
-    def register_clock_callback(self, callback, data=None):
+    def subscribe_clock(self, callback, data=None, division=DIVISION_TICK, phase=0, idle_callback=None):
         """
-        called from effect manager to register its clock callback
+        called from effect manager, callback runs every division ticks offset by phase, see ClockBus
         """
+        subscription = self.clock_bus.subscribe(callback, data, division, phase, idle_callback)
         if self.clock is not None:
-            self.clock.stop_clock()
-            self.clock.register_clock_callback(callback, data) 
-            self.clock.start_clock()
+            self.clock.wake() # may be idle with no one to tick for
+        return subscription
+
+    def unsubscribe_clock(self, subscription):
+        self.clock_bus.unsubscribe(subscription)
 
-        # rememeber in case we switch clock sources
-        self.clock_callback = callback
-        self.clock_data = data
 
+    def panic(self, reset=None, callback=None):
+        """
+        does not wait, callback() on the panic thread when the last message has gone.
+        reset, or the PanicReset setting, also resets every channel for notes we did not send
+        """
+        if reset is None:
+            reset = self.settings.get('PanicReset', False)
+        self.panic_scheduler.panic(reset, callback)
 
-    def panic(self):
-        self.midiout.panic()
+    def get_panic_stats(self):
+        return self.panic_scheduler.get_stats()
 
     def destroy(self):
         """
@@ -555,6 +1708,11 @@ class MidiManager():
         """
         if self.internal_clock is not None:
             self.internal_clock.register_clock_callback(callback=None)
+            self.internal_clock.wake() # an idle thread would otherwise hold up exit until its wait times out
+        self.clock_out.stop()
+        self.panic_scheduler.stop()
+        for port in self.clock_out_ports.values():
+            port.close_port() # still in settings for next time
         self.midiin.close_port()
         self.midiout.close_port()
 
@@ -767,6 +1925,7 @@ class CCControls:
             ui_callback[0](value, ui_callback[1])
             
 
+
 class MidiMessage:
     """
     compose a midi message from its parts
@@ -778,7 +1937,7 @@ class MidiMessage:
         else:
             type = NOTE_OFF
 
-        self.message = [type & 0xF0 | channel, midi_number, velocity]
+        self.message = note_message(type & 0xF0 | channel, midi_number, velocity)
 
     def get_message(self):
         return self.message
@@ -790,17 +1949,17 @@ class MidiNoteMessage:
     decompose a midi message to its parts
     """
     def __init__(self, message):
-        self.data_type = message[0] & 0xF0
-        self.channel = message[0] & 0x0F
+        self.data_type = (message >> 16) & 0xF0
+        self.channel = (message >> 16) & 0x0F
         if self.data_type == NOTE_OFF or self.data_type == NOTE_ON:
-            self.velocity = message[2]
-            self.note = message[1]
-            self.type_channel = message[0]
+            self.velocity = message & 0x7F
+            self.note = (message >> 8) & 0x7F
+            self.type_channel = message >> 16
         else:
             raise Exception('Not a midi note message')
 
     def get_message(self):
-        return [self.type_channel, self.note, self.velocity]
+        return pack_message(self.type_channel, self.note, self.velocity)
 
     def is_note_on(self):
         if self.data_type == NOTE_ON:
@@ -825,34 +1984,30 @@ MAX_OCTAVE = 9
 OCTAVES = list(range(11))
 NOTES_IN_OCTAVE = len(NOTES)
 
+# name to number both ways without a search
+NOTE_INDEX = {name: i for i, name in enumerate(NOTES)} # place in the octave
+NOTE_NAMES = tuple(NOTES[number % NOTES_IN_OCTAVE] + str(number // NOTES_IN_OCTAVE) for number in range(128))
+NOTE_NUMBERS = {(octave, name): i + ((octave + 1) * NOTES_IN_OCTAVE)
+                for octave in range(MIN_OCTAVE, MAX_OCTAVE + 1) for i, name in enumerate(NOTES)
+                if i + ((octave + 1) * NOTES_IN_OCTAVE) <= 127}
+
 def midi_number_to_note(number):
     """
     convert midi note number to string i.e. "C2"
     """
-    octave = number // NOTES_IN_OCTAVE
-    note = NOTES[number % NOTES_IN_OCTAVE] + str(octave)
-    return note
+    return NOTE_NAMES[number]
 
 def note_to_midi_number(octave, note):
     """
     convert octave and string note to midi number
     octaves are -1, 0 - 9 midi notes 0 - 127 stops at G9
-    o
     """
-    try:
-        ni = NOTES.index(note)
-    except ValueError:
-        log.error(f'Bad note {note}')
-        return None
-
-    octave += 1
-
-    number = ni + (octave * 12)
-
-    if number < 0 or number > 127:
-        log.error('Bad midi note or octave')
+    number = NOTE_NUMBERS.get((octave, note))
+    if number is None:
+        if note not in NOTE_INDEX:
+            log.error(f'Bad note {note}')
+        else:
+            log.error('Bad midi note or octave')
         return None
 
     return number
-
-
@@ -0,0 +1,386 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+ 
+ This file is part of MIDI project
+ 
+ MIDI can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import threading
+import logging
+
+logging.basicConfig(level=logging.ERROR)
+log = logging.getLogger(__name__)
+
+"""
+ packed messages and what works on them on the way out, nothing here needs rtmidi
+ so it can be used and checked without a midi port. common.midi imports all of it
+"""
+# status and controller numbers, as in rtmidi.midiconstants
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+ALL_SOUND_OFF = 0x78
+RESET_ALL_CONTROLLERS = 0x79
+ALL_NOTES_OFF = 0x7B
+
+# when an output is over its voice limit which sounding note makes room
+VOICE_STEALING = ['oldest', 'quietest', 'priority']
+# how much a note is worth keeping when stealing by priority
+VOICE_GENERATED = 0 # echoes, chord and beat notes
+VOICE_PLAYED = 1 # what the player played, passed through
+
+"""
+ messages inside the app are one int, status << 16 | data1 << 8 | data2, so a note costs
+ the int and nothing else and its parts come out with a shift and a mask.
+ Hot paths do the shifts inline, these are for the rest. Lists are only for rtmidi
+"""
+def pack_message(status, data1=0, data2=0):
+    return (status << 16) | (data1 << 8) | data2
+
+def message_from_list(message):
+    """
+    from rtmidi, notes and the other channel messages
+    """
+    packed = message[0] << 16
+    if len(message) > 1:
+        packed |= message[1] << 8
+    if len(message) > 2:
+        packed |= message[2]
+    return packed
+
+def message_to_list(message):
+    """
+    for rtmidi, as many bytes as the status has
+    """
+    status = message >> 16
+    length = message_length(message)
+    if length == 3:
+        return [status, (message >> 8) & 0x7F, message & 0x7F]
+    if length == 2:
+        return [status, (message >> 8) & 0x7F]
+    return [status]
+
+def message_length(message):
+    status = message >> 16
+    if status >= 0xF0:
+        return SYSTEM_MESSAGE_LENGTHS.get(status, 1)
+    if status & 0xE0 == 0xC0: # program change and channel pressure
+        return 2
+    return 3
+
+SYSTEM_MESSAGE_LENGTHS = {0xF1: 2, 0xF2: 3, 0xF3: 2}
+
+def message_status(message):
+    return message >> 16
+
+def message_type(message):
+    return (message >> 16) & 0xF0
+
+def message_channel(message):
+    return (message >> 16) & 0x0F
+
+def message_note(message):
+    return (message >> 8) & 0x7F
+
+def message_velocity(message):
+    return message & 0x7F
+
+def message_is_note_on(message):
+    return (message >> 16) & 0xF0 == NOTE_ON and message & 0x7F > 0
+
+def message_is_note_off(message):
+    data_type = (message >> 16) & 0xF0
+    return data_type == NOTE_OFF or (data_type == NOTE_ON and message & 0x7F == 0)
+
+def note_off_message(message):
+    """
+    the note off for a note message, same channel and note
+    """
+    return NOTE_OFF_MESSAGES[((message >> 9) & 0x0780) | ((message >> 8) & 0x7F)]
+
+"""
+ note messages are made once and shared, so sending one makes nothing, see pack_message.
+ Both tables are by channel << 7 | note. Note on rows hold every velocity and
+ are made the first time their note plays, most of the 2048 never are
+"""
+NOTE_OFF_MESSAGES = tuple(pack_message(NOTE_OFF | (index >> 7), index & 0x7F) for index in range(16 * 128))
+note_on_rows = [None] * (16 * 128)
+
+def note_on_row(channel, note):
+    """
+    the note ons of channel and note by velocity
+    """
+    index = (channel << 7) | note
+    row = note_on_rows[index]
+    if row is None:
+        row = tuple(pack_message(NOTE_ON | channel, note, velocity) for velocity in range(128))
+        note_on_rows[index] = row # two threads might both make it, either will do
+    return row
+
+def note_message(status, note, velocity):
+    """
+    a packed note on or off from the tables
+    """
+    if status & 0xF0 == NOTE_ON:
+        return note_on_row(status & 0x0F, note)[velocity]
+    if velocity == 0:
+        return NOTE_OFF_MESSAGES[((status & 0x0F) << 7) | note]
+    return pack_message(status, note, velocity) # an off with release velocity, rare
+
+
+class RunningStatusEncoder:
+    """
+    sits just before the wire. Note offs go as note on velocity 0 so a run of notes shares
+    one status byte, a note off for a note not sounding and a control change that repeats
+    the last value are dropped. Counts what the wire would carry with running status,
+    rtmidi gets the whole message and the driver does the same for hardware ports,
+    encode gives the actual bytes for a serial or network sink.
+    """
+    # data entry and increment mean something every time they come
+    ALWAYS_SENT_CC = (6, 38, 96, 97)
+
+    def __init__(self, note_off_as_note_on=True, drop_redundant=True):
+        self.note_off_as_note_on = note_off_as_note_on
+        self.drop_redundant = drop_redundant
+        self.lock = threading.Lock() # clock, dispatcher, budget and input threads all write
+        self.sounding = bytearray(16 * 128) # note ons sent, per channel and note
+        self.cc_values = bytearray(b'\xff' * (16 * 128)) # 0xff not sent yet
+        self.last_status = None
+        self.in_bytes = 0
+        self.out_bytes = 0
+        self.dropped = 0
+
+    def reset(self):
+        """
+        after anything that went around us, like a panic
+        """
+        with self.lock:
+            self.sounding = bytearray(16 * 128)
+            self.cc_values = bytearray(b'\xff' * (16 * 128))
+            self.last_status = None
+
+    def process(self, message):
+        """
+        message as it should go out, None if it need not
+        """
+        with self.lock:
+            return self.update(message)
+
+    def update(self, message):
+        """
+        process with the lock held, for a caller that keeps it while the message goes out
+        """
+        status = message >> 16
+        self.in_bytes += message_length(message)
+        data_type = status & 0xF0
+        if data_type == NOTE_ON or data_type == NOTE_OFF:
+            index = ((message >> 9) & 0x0780) | ((message >> 8) & 0x7F) # channel << 7 | note
+            if data_type == NOTE_ON and message & 0x7F > 0:
+                if self.sounding[index] < 255:
+                    self.sounding[index] += 1
+            elif self.sounding[index] == 0:
+                if self.drop_redundant:
+                    self.dropped += 1
+                    return None
+            else:
+                self.sounding[index] -= 1
+                if data_type == NOTE_OFF and self.note_off_as_note_on:
+                    message = note_on_row(status & 0x0F, (message >> 8) & 0x7F)[0]
+        elif data_type == CONTROL_CHANGE:
+            controller = (message >> 8) & 0x7F
+            index = ((message >> 9) & 0x0780) | controller
+            if controller >= ALL_SOUND_OFF:
+                # channel mode, always goes, some of them end every note on the channel
+                start = (status & 0x0F) << 7
+                if controller in (ALL_SOUND_OFF, ALL_NOTES_OFF):
+                    self.sounding[start:start + 128] = bytes(128)
+                elif controller == RESET_ALL_CONTROLLERS:
+                    self.cc_values[start:start + 128] = b'\xff' * 128
+            elif self.drop_redundant and self.cc_values[index] == message & 0x7F and controller not in self.ALWAYS_SENT_CC:
+                self.dropped += 1
+                return None
+            else:
+                self.cc_values[index] = message & 0x7F
+
+        self.out_bytes += self.wire_size(message)
+        return message
+
+    def wire_size(self, message):
+        status = message >> 16
+        length = message_length(message)
+        if status >= 0xF8:
+            return length # realtime goes anywhere, running status carries on
+        if status >= 0xF0:
+            self.last_status = None # system common ends running status
+            return length
+        if status == self.last_status:
+            return length - 1
+        self.last_status = status
+        return length
+
+    def encode(self, message):
+        """
+        the bytes on the wire, empty if dropped
+        """
+        with self.lock:
+            last_status = self.last_status
+            message = self.update(message)
+        if message is None:
+            return b''
+        data = message_to_list(message)
+        if data[0] < 0xF0 and data[0] == last_status:
+            return bytes(data[1:])
+        return bytes(data)
+
+    def get_stats(self):
+        return {'in_bytes': self.in_bytes,
+                'out_bytes': self.out_bytes,
+                'saved_bytes': self.in_bytes - self.out_bytes,
+                'dropped': self.dropped}
+
+
+class VoiceAllocator:
+    """
+    caps the notes sounding on an output, and on each channel of it. A note on over the cap
+    steals a sounding note, we send its note off and swallow the one that comes later.
+    stealing picks the oldest, the quietest, or by priority: generated before played notes,
+    then quietest so echo tails go first, then oldest.
+    With priority a new note that ranks below every candidate is not played instead.
+    """
+    def __init__(self, max_voices=0, max_per_channel=0, stealing='priority'):
+        self.max_voices = max_voices # 0 no limit
+        self.max_per_channel = max_per_channel
+        if stealing not in VOICE_STEALING:
+            log.error(f'Unknown voice stealing {stealing}, using priority')
+            stealing = 'priority'
+        self.stealing = stealing
+        self.lock = threading.Lock()
+        self.voices = {} # (channel, note): [seq, priority, velocity] while sounding
+        self.held = {} # (channel, note): note ons still to get their off
+        self.swallow = {} # (channel, note): note offs we already sent ourselves
+        self.channel_voices = [0] * 16
+        self.seq = 0
+        self.steals = 0
+        self.refused = 0
+
+    def reset(self):
+        with self.lock:
+            self.voices.clear()
+            self.held.clear()
+            self.swallow.clear()
+            self.channel_voices = [0] * 16
+
+    def process(self, message, priority):
+        """
+        the messages to send in its place
+        """
+        data_type = (message >> 16) & 0xF0
+        if data_type != NOTE_ON and data_type != NOTE_OFF:
+            return [message]
+
+        key = ((message >> 16) & 0x0F, (message >> 8) & 0x7F)
+        with self.lock:
+            if data_type == NOTE_OFF or message & 0x7F == 0:
+                return self.note_off(key, message)
+            return self.note_on(key, message, priority)
+
+    def note_off(self, key, message):
+        swallow = self.swallow.get(key, 0)
+        if swallow > 0:
+            if swallow == 1:
+                del self.swallow[key]
+            else:
+                self.swallow[key] = swallow - 1
+            return []
+
+        self.end_voice(key)
+        return [message]
+
+    def end_voice(self, key):
+        held = self.held.get(key, 0)
+        if held > 1:
+            self.held[key] = held - 1
+        elif held == 1:
+            del self.held[key]
+            del self.voices[key]
+            self.channel_voices[key[0]] -= 1
+
+    def release(self, channel, note):
+        """
+        a note on we let through never went out, free its voice as if its note off had come.
+        The caller drops that note off so we never see it
+        """
+        with self.lock:
+            self.end_voice((channel, note))
+
+    def note_on(self, key, message, priority):
+        self.seq += 1
+        voice = self.voices.get(key)
+        if voice is not None:
+            # struck again, the synth retriggers the same voice
+            voice[0] = self.seq
+            voice[1] = priority
+            voice[2] = message & 0x7F
+            self.held[key] += 1
+            return [message]
+
+        new_voice = [self.seq, priority, message & 0x7F]
+        out = []
+        channel = key[0]
+        while True:
+            if self.max_per_channel and self.channel_voices[channel] >= self.max_per_channel:
+                victim = self.choose_victim(channel)
+            elif self.max_voices and len(self.voices) >= self.max_voices:
+                victim = self.choose_victim(None)
+            else:
+                break
+
+            if self.stealing == 'priority' and self.rank(new_voice) < self.rank(self.voices[victim]):
+                self.refused += 1
+                self.swallow[key] = self.swallow.get(key, 0) + 1
+                return out
+
+            # an off for each note on it had so the output's count of it comes back to 0
+            held = self.held.pop(victim)
+            out.extend([NOTE_OFF_MESSAGES[(victim[0] << 7) | victim[1]]] * held)
+            self.steals += 1
+            self.swallow[victim] = self.swallow.get(victim, 0) + held
+            del self.voices[victim]
+            self.channel_voices[victim[0]] -= 1
+
+        self.voices[key] = new_voice
+        self.held[key] = 1
+        self.channel_voices[channel] += 1
+        out.append(message)
+        return out
+
+    def rank(self, voice):
+        """
+        lowest goes first
+        """
+        seq, priority, velocity = voice
+        if self.stealing == 'oldest':
+            return (seq,)
+        if self.stealing == 'quietest':
+            return (velocity, seq)
+        return (priority, velocity, seq)
+
+    def choose_victim(self, channel):
+        victim = None
+        victim_rank = None
+        for key, voice in self.voices.items():
+            if channel is not None and key[0] != channel:
+                continue
+            rank = self.rank(voice)
+            if victim is None or rank < victim_rank:
+                victim = key
+                victim_rank = rank
+        return victim
+
+    def get_stats(self):
+        return {'max_voices': self.max_voices,
+                'max_per_channel': self.max_per_channel,
+                'sounding': len(self.voices),
+                'steals': self.steals,
+                'refused': self.refused}
@@ -0,0 +1,461 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+
+ This file is part of MIDI project
+
+ MIDI can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import os
+import sys
+import time
+import select
+import logging
+
+logging.basicConfig(level=logging.ERROR)
+log = logging.getLogger(__name__)
+
+NS_PER_SEC = 1000000000
+
+CLOCK_BACKENDS = ['sleep', 'hybrid', 'timerfd']
+
+
+class SleepWaiter:
+    """
+    waits for an absolute perf_counter_ns deadline with plain time.sleep
+    """
+    def __init__(self):
+        self.late_ns = 0 # how late the last wake up was
+
+    def wait_until(self, deadline_ns):
+        now = time.perf_counter_ns()
+        if deadline_ns > now:
+            time.sleep((deadline_ns - now) / NS_PER_SEC)
+            now = time.perf_counter_ns()
+
+        self.late_ns = now - deadline_ns
+        return now
+
+    def get_stats(self):
+        return {'late_ns': self.late_ns}
+
+
+class HybridWaiter:
+    """
+    sleeps to just short of a deadline then spins for the rest.
+    The spin margin follows the measured sleep overshoot, but is capped
+    so spinning stays within cpu_budget (0 - 1) of the time spent waiting.
+    """
+    def __init__(self, cpu_budget=0.1, margin_ns=500000):
+        self.cpu_budget = cpu_budget
+        self.margin_ns = margin_ns # we wake from sleep this early and spin
+        self.overshoot_ns = margin_ns // 2 # running average of sleep overshoot
+        self.overshoot_dev_ns = margin_ns // 4 # and its mean deviation
+        self.interval_ns = 0 # running average of time we are asked to wait
+        self.late_ns = 0 # how late the last wake up was
+        self.spin_ns = 0 # totals so we can report the actual cpu spent spinning
+        self.wait_ns = 0
+
+    def calibrate(self, overshoot_ns):
+        """
+        track sleep overshoot like TCP tracks round trip time, average plus deviation
+        """
+        err = overshoot_ns - self.overshoot_ns
+        self.overshoot_ns += err // 8
+        self.overshoot_dev_ns += (abs(err) - self.overshoot_dev_ns) // 4
+
+    def adjust(self, wait_ns):
+        self.interval_ns += (wait_ns - self.interval_ns) // 8
+        margin = self.overshoot_ns + (4 * self.overshoot_dev_ns)
+        budget = int(self.cpu_budget * self.interval_ns)
+        if margin > budget:
+            margin = budget
+
+        if margin < 0:
+            margin = 0
+
+        self.margin_ns = margin
+
+    def wait_until(self, deadline_ns):
+        now = time.perf_counter_ns()
+        wait_ns = deadline_ns - now
+        if wait_ns <= 0:
+            self.late_ns = -wait_ns
+            return now
+
+        sleep_ns = wait_ns - self.margin_ns
+        if sleep_ns > 0:
+            time.sleep(sleep_ns / NS_PER_SEC)
+            woke = time.perf_counter_ns()
+            self.calibrate(woke - (now + sleep_ns))
+            now = woke
+
+        spin_start = now
+        while now < deadline_ns:
+            now = time.perf_counter_ns()
+
+        self.spin_ns += now - spin_start
+        self.wait_ns += wait_ns
+        self.late_ns = now - deadline_ns
+        self.adjust(wait_ns)
+        return now
+
+    def get_stats(self):
+        spin_fraction = 0.0
+        if self.wait_ns > 0:
+            spin_fraction = self.spin_ns / self.wait_ns
+
+        return {'late_ns': self.late_ns,
+                'margin_ns': self.margin_ns,
+                'overshoot_ns': self.overshoot_ns,
+                'spin_fraction': spin_fraction}
+
+
+class DeadlineTicker:
+    """
+    periodic ticks, tick N is due at anchor + N * period and a waiter gets us there
+    """
+    def __init__(self, waiter):
+        self.waiter = waiter
+        self.period_ns = 0
+        self.anchor_ns = 0
+        self.n = 0 # ticks since anchor
+
+    def start(self, period_ns, anchor_ns=None):
+        """
+        tick 0 is at anchor_ns, now if not given
+        """
+        self.period_ns = period_ns
+        self.anchor_ns = time.perf_counter_ns() if anchor_ns is None else anchor_ns
+        self.n = 0
+
+    def set_period(self, period_ns):
+        """
+        new phase starts at the deadline of the last tick
+        """
+        self.anchor_ns += self.n * self.period_ns
+        self.period_ns = period_ns
+        self.n = 0
+
+    def last_deadline_ns(self):
+        return self.anchor_ns + (self.n * self.period_ns)
+
+    def wait(self):
+        """
+        returns the number of ticks due, more than 1 means we missed some
+        """
+        deadline = self.anchor_ns + ((self.n + 1) * self.period_ns)
+        now = time.perf_counter_ns()
+        if deadline > now:
+            now = self.waiter.wait_until(deadline)
+
+        expirations = (now - self.anchor_ns) // self.period_ns - self.n
+        self.n += expirations
+        return expirations
+
+    def resync(self):
+        """
+        catch up after not waiting for a while, returns the ticks that went by
+        """
+        passed = (time.perf_counter_ns() - self.anchor_ns) // self.period_ns - self.n
+        self.n += passed
+        return passed
+
+    def stop(self):
+        pass
+
+    def get_stats(self):
+        return self.waiter.get_stats()
+
+
+class TimerFdTicker:
+    """
+    Linux periodic timerfd, the kernel keeps the period and
+    reading the fd returns how many expirations happened since the last read
+    """
+    def __init__(self):
+        self.fd = None
+        self.epoll = None
+        self.period_ns = 0
+        self.anchor_ns = 0
+        self.n = 0
+        self.late_ns = 0
+        self.settime = None
+        if hasattr(os, 'timerfd_create'):
+            self.fd = os.timerfd_create(time.CLOCK_MONOTONIC, flags=os.TFD_CLOEXEC)
+            self.settime = self.os_settime
+        else:
+            self.libc_setup()
+
+        self.epoll = select.epoll()
+        self.epoll.register(self.fd, select.EPOLLIN)
+
+    def libc_setup(self):
+        """
+        older pythons, go straight to libc
+        """
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        class itimerspec(ctypes.Structure):
+            _fields_ = [('it_interval', timespec), ('it_value', timespec)]
+
+        self.itimerspec = itimerspec
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # CLOCK_MONOTONIC is 1, TFD_CLOEXEC is O_CLOEXEC
+        self.fd = self.libc.timerfd_create(1, os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'timerfd_create failed')
+
+        self.settime = self.libc_settime
+
+    def os_settime(self, initial_ns, interval_ns):
+        os.timerfd_settime_ns(self.fd, flags=os.TFD_TIMER_ABSTIME, initial=initial_ns, interval=interval_ns)
+
+    def libc_settime(self, initial_ns, interval_ns):
+        import ctypes
+        spec = self.itimerspec()
+        spec.it_value.tv_sec, spec.it_value.tv_nsec = divmod(initial_ns, NS_PER_SEC)
+        spec.it_interval.tv_sec, spec.it_interval.tv_nsec = divmod(interval_ns, NS_PER_SEC)
+        if self.libc.timerfd_settime(self.fd, 1, ctypes.byref(spec), None) != 0: # 1 = TFD_TIMER_ABSTIME
+            raise OSError(ctypes.get_errno(), 'timerfd_settime failed')
+
+    def arm(self):
+        # perf_counter is CLOCK_MONOTONIC on linux so our deadlines are the kernel's
+        self.settime(self.anchor_ns + self.period_ns, self.period_ns)
+
+    def start(self, period_ns, anchor_ns=None):
+        """
+        tick 0 is at anchor_ns, now if not given
+        """
+        self.period_ns = period_ns
+        self.anchor_ns = time.perf_counter_ns() if anchor_ns is None else anchor_ns
+        self.n = 0
+        self.arm()
+
+    def set_period(self, period_ns):
+        """
+        new phase starts at the deadline of the last tick
+        """
+        self.anchor_ns += self.n * self.period_ns
+        self.period_ns = period_ns
+        self.n = 0
+        self.arm()
+
+    def last_deadline_ns(self):
+        return self.anchor_ns + (self.n * self.period_ns)
+
+    def wait(self):
+        """
+        returns the number of ticks due, more than 1 means we missed some
+        """
+        while True:
+            try:
+                if self.epoll.poll(1.0):
+                    break
+            except InterruptedError:
+                pass
+
+        expirations = int.from_bytes(os.read(self.fd, 8), sys.byteorder)
+        self.n += expirations
+        self.late_ns = time.perf_counter_ns() - self.last_deadline_ns()
+        return expirations
+
+    def resync(self):
+        """
+        catch up after not waiting for a while, returns the ticks that went by
+        """
+        if not self.epoll.poll(0):
+            return 0
+
+        passed = int.from_bytes(os.read(self.fd, 8), sys.byteorder)
+        self.n += passed
+        return passed
+
+    def stop(self):
+        if self.fd is None:
+            return
+
+        self.epoll.close()
+        os.close(self.fd)
+        self.fd = None
+
+    def get_stats(self):
+        return {'late_ns': self.late_ns}
+
+    def __del__(self):
+        self.stop()
+
+
+def make_ticker(backend, cpu_budget=0.1):
+    """
+    clock backends are picked by name in settings, see CLOCK_BACKENDS
+    """
+    if backend == 'timerfd':
+        try:
+            return TimerFdTicker()
+        except (AttributeError, OSError, TypeError) as e:
+            log.error(f'timerfd clock not available, using hybrid: {e}')
+            backend = 'hybrid'
+
+    if backend == 'sleep':
+        return DeadlineTicker(SleepWaiter())
+
+    if backend != 'hybrid':
+        log.error(f'Unknown clock backend {backend}, using hybrid')
+
+    return DeadlineTicker(HybridWaiter(cpu_budget=cpu_budget))
+
+
+class ClockPll:
+    """
+    phase locked loop on incoming clock ticks, an alpha beta filter.
+    Each arrival corrects the predicted tick time (phase) by kp of the error and the
+    period (tempo) by ki of it, hard while acquiring and gently once locked,
+    so arrival jitter is filtered out of both.
+    """
+    def __init__(self, acquire_gains=(0.5, 0.15), lock_gains=(0.1, 0.005), lock_ticks=24):
+        self.acquire_gains = acquire_gains
+        self.lock_gains = lock_gains
+        self.lock_ticks = lock_ticks # this many good ticks in a row and we are locked
+        self.reset()
+
+    def reset(self):
+        self.tick_ns = None # filtered time of the last tick
+        self.period_ns = 0
+        self.locked = False
+        self.good = 0
+        self.error_ns = 0 # last phase error
+        self.jitter_ns = 0 # running average of abs phase error
+        self.relocks = 0
+
+    def update(self, arrival_ns):
+        """
+        a tick arrived, returns its filtered time
+        """
+        if self.tick_ns is None:
+            self.tick_ns = arrival_ns
+            return self.tick_ns
+
+        if self.period_ns <= 0:
+            self.period_ns = arrival_ns - self.tick_ns
+            self.tick_ns = arrival_ns
+            return self.tick_ns
+
+        predicted = self.tick_ns + self.period_ns
+        err = arrival_ns - predicted
+        if abs(err) > self.period_ns // 2:
+            # tempo jumped or the clock paused, start again from here
+            self.period_ns = arrival_ns - self.tick_ns
+            self.tick_ns = arrival_ns
+            self.locked = False
+            self.good = 0
+            self.relocks += 1
+            return self.tick_ns
+
+        kp, ki = self.lock_gains if self.locked else self.acquire_gains
+        self.error_ns = err
+        self.tick_ns = predicted + int(kp * err)
+        self.period_ns += int(ki * err)
+        self.jitter_ns += (abs(err) - self.jitter_ns) // 8
+
+        if abs(err) < self.period_ns // 16:
+            self.good += 1
+            if self.good >= self.lock_ticks:
+                self.locked = True
+        else:
+            self.good = 0
+            self.locked = False
+
+        return self.tick_ns
+
+    def freewheel(self):
+        """
+        no tick came, carry on at the current tempo, returns the time of the tick we stood in for
+        """
+        self.tick_ns += self.period_ns
+        return self.tick_ns
+
+    def relock(self, arrival_ns):
+        """
+        ticks are back but off our phase, take theirs and keep our tempo
+        """
+        self.tick_ns = arrival_ns
+        self.locked = False
+        self.good = 0
+        self.relocks += 1
+        return self.tick_ns
+
+    def next_tick_ns(self):
+        return self.tick_ns + self.period_ns
+
+    def get_stats(self):
+        return {'locked': self.locked,
+                'period_ns': self.period_ns,
+                'error_ns': self.error_ns,
+                'jitter_ns': self.jitter_ns,
+                'relocks': self.relocks}
+
+
+REALTIME_POLICIES = ['fifo', 'rr']
+
+# thread name: what we actually got, shown on the midi screen
+realtime_report = {}
+
+def set_thread_realtime(name, settings):
+    """
+    opt in with the RealtimeThreads setting. Gives the calling thread
+    SCHED_FIFO or SCHED_RR priority and pins it to RealtimeCPUs if allowed,
+    then records the effective policy and affinity whether we got them or not.
+    """
+    if settings is None or settings.get('RealtimeThreads', False) != True:
+        return
+
+    if hasattr(os, 'sched_setscheduler') == False:
+        realtime_report[name] = 'realtime not supported'
+        return
+
+    notes = []
+    policy = settings.get('RealtimePolicy', 'fifo')
+    if policy not in REALTIME_POLICIES:
+        log.error(f'Unknown realtime policy {policy}, using fifo')
+        policy = 'fifo'
+
+    sched = os.SCHED_FIFO if policy == 'fifo' else os.SCHED_RR
+    priority = settings.get('RealtimePriority', 40)
+    priority = max(os.sched_get_priority_min(sched), min(priority, os.sched_get_priority_max(sched)))
+    try:
+        os.sched_setscheduler(0, sched, os.sched_param(priority)) # 0 is the calling thread on linux
+    except OSError as e:
+        log.error(f'{name}: cannot set {policy} priority {priority}: {e}')
+        notes.append('no rt permission')
+
+    cpus = settings.get('RealtimeCPUs', [])
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (OSError, ValueError) as e:
+            log.error(f'{name}: cannot pin to cpus {cpus}: {e}')
+            notes.append('no pinning')
+
+    # report what the kernel says we have, not what we asked for
+    effective = os.sched_getscheduler(0)
+    if effective == os.SCHED_FIFO:
+        text = f'FIFO {os.sched_getparam(0).sched_priority}'
+    elif effective == os.SCHED_RR:
+        text = f'RR {os.sched_getparam(0).sched_priority}'
+    else:
+        text = 'normal'
+
+    text += ', cpus ' + ','.join(str(c) for c in sorted(os.sched_getaffinity(0)))
+    if notes:
+        text += ' (' + ', '.join(notes) + ')'
+
+    realtime_report[name] = text
+    log.info(f'{name} thread scheduling: {text}')
+
+def get_realtime_report():
+    return '   '.join(f'{name}: {text}' for name, text in realtime_report.items())
@@ -8,14 +8,17 @@
 """
 import os
 import glob
-import queue
 import logging
+import threading
+from collections import deque
 from pathlib import Path
 #import shelve
 from datetime import datetime
 #import rsa
 import json
 
+from common.midi_messages import message_is_note_off
+
 logging.basicConfig(level=logging.ERROR)
 log = logging.getLogger(__name__)
 
@@ -202,53 +205,416 @@ class Settings:
         
 
 
+WHEEL_BITS = 8
+WHEEL_SIZE = 1 << WHEEL_BITS # slots per level
+WHEEL_MASK = WHEEL_SIZE - 1
+WHEEL_LEVELS = 3 # covers 2^24 ticks, further out goes in overflow
+
+
+class TimingWheel:
+    """
+    hierarchical timing wheel of items keyed by tick
+    Level 0 has a slot per tick for the next 256 ticks, each level up covers 256 times
+    as much in coarser slots which cascade down a level as their time gets near.
+    Insert is O(1), advancing a tick is O(1) plus whatever expires or cascades.
+    Expired items wait in due in tick order.
+    """
+    def __init__(self, tick=0):
+        self.now = tick # ticks up to and including this have expired
+        self.levels = [[[] for slot in range(WHEEL_SIZE)] for level in range(WHEEL_LEVELS)]
+        self.overflow = []
+        self.pending = 0 # items in the wheel not yet due
+        self.due = deque() # (tick, item) ready to go
+
+    def __len__(self):
+        return self.pending + len(self.due)
+
+    def insert(self, tick, item):
+        if tick <= self.now:
+            self.due.append((tick, item))
+            return
+
+        self.pending += 1
+        if tick - self.now < WHEEL_SIZE:
+            # most land in the next WHEEL_SIZE ticks
+            self.levels[0][tick & WHEEL_MASK].append((tick, item))
+            return
+
+        self.place((tick, item))
+
+    def place(self, entry):
+        tick = entry[0]
+        delta = tick - self.now
+        for level in range(WHEEL_LEVELS):
+            shift = level * WHEEL_BITS
+            if delta < (WHEEL_SIZE << shift):
+                self.levels[level][(tick >> shift) & WHEEL_MASK].append(entry)
+                return
+
+        self.overflow.append(entry)
+
+    def cascade(self, level, slot):
+        entries = self.levels[level][slot]
+        if not entries:
+            return
+
+        self.levels[level][slot] = []
+        for entry in entries:
+            self.place(entry)
+
+    def rebucket(self, tick):
+        """
+        a big jump in time, cheaper to sort everything out again than to walk every tick
+        """
+        entries = self.overflow
+        self.overflow = []
+        for level in self.levels:
+            for slot in range(WHEEL_SIZE):
+                if level[slot]:
+                    entries.extend(level[slot])
+                    level[slot] = []
+
+        self.now = tick
+        self.pending = 0
+        entries.sort(key=lambda entry: entry[0])
+        for entry in entries:
+            self.insert(entry[0], entry[1])
+
+    def cascading(self, tick):
+        """
+        entries still up a level that come down when the wheel reaches tick
+        """
+        for level in range(1, WHEEL_LEVELS):
+            shift = level * WHEEL_BITS
+            if tick & ((1 << shift) - 1) == 0:
+                yield from self.levels[level][(tick >> shift) & WHEEL_MASK]
+
+        if tick & ((1 << (WHEEL_BITS * WHEEL_LEVELS)) - 1) == 0:
+            yield from self.overflow
+
+    def next_due(self, limit):
+        """
+        earliest tick before limit that has something in it, None if none do.
+        For peeking a short way ahead, no further than WHEEL_SIZE ticks.
+        Cancelled items count, they are only skipped when they come due
+        """
+        if self.due:
+            # a take ahead of the clock can leave some here that are not due yet, nothing in the wheel is earlier
+            first = min(entry[0] for entry in self.due)
+            if first < limit:
+                return first
+            return None
+
+        if self.pending == 0:
+            return None
+
+        end = min(limit, self.now + WHEEL_SIZE)
+        level0 = self.levels[0]
+        first = None
+        for t in range(self.now + 1, end):
+            if t & WHEEL_MASK == 0:
+                for entry in self.cascading(t):
+                    if entry[0] < end and (first is None or entry[0] < first):
+                        first = entry[0]
+
+            if level0[t & WHEEL_MASK]:
+                # a level 0 slot only holds its one tick in the next WHEEL_SIZE
+                if first is None or t < first:
+                    first = t
+                break
+
+        return first
+
+    def advance(self, tick):
+        """
+        expire everything up to and including tick into due
+        """
+        if tick <= self.now:
+            return
+
+        if self.pending == 0:
+            self.now = tick
+            return
+
+        if tick - self.now > WHEEL_SIZE:
+            self.rebucket(tick)
+            return
+
+        level0 = self.levels[0]
+        while self.now < tick:
+            self.now += 1
+            t = self.now
+            if t & WHEEL_MASK == 0:
+                # crossed into a new block, bring the next one down from above
+                if t & ((1 << (WHEEL_BITS * WHEEL_LEVELS)) - 1) == 0:
+                    overflow = self.overflow
+                    self.overflow = []
+                    for entry in overflow:
+                        self.place(entry)
+                for level in range(WHEEL_LEVELS - 1, 0, -1):
+                    shift = level * WHEEL_BITS
+                    if t & ((1 << shift) - 1) == 0:
+                        self.cascade(level, (t >> shift) & WHEEL_MASK)
+
+            slot = t & WHEEL_MASK
+            entries = level0[slot]
+            if entries:
+                level0[slot] = []
+                self.pending -= len(entries)
+                self.due.extend(entries)
+
+
+class NoteEvent:
+    """
+    handle to a scheduled message, returned by NoteManager.add so it can be cancelled
+    key is channel << 7 | note for note messages
+    An event with an expander instead of a message asks it for a message each time
+    it comes due and is rescheduled at the tick it returns, see NoteManager.add_expander
+    """
+    __slots__ = ('tick', 'message', 'expander', 'key', 'owner', 'pending', 'generation')
+
+    def __init__(self, tick, message, owner=None, generation=0, expander=None, key=None):
+        self.tick = tick
+        self.message = message
+        self.expander = expander
+        self.key = key
+        if key is None and message is not None:
+            self.key = ((message >> 9) & 0x0780) | ((message >> 8) & 0x7F) # packed, see pack_message
+        self.owner = owner
+        self.pending = True # false once sent or cancelled
+        self.generation = generation # NoteManager purge generation
+
+    def is_note_off(self):
+        return self.message is not None and message_is_note_off(self.message) # note on velocity 0 as well
+
+
 class NoteManager:
     """
-    A simple priority queue of note events
-    These are added at clock tick priority and examined 
-    if it is their time to be sent out
+    A timing wheel of note events
+    These are added at clock tick priority and sent out
+    when their tick comes around. Events can be cancelled singly,
+    by channel and note or by the owner that added them.
     """
 
     def __init__(self):
-        self.note_events = queue.PriorityQueue()
+        self.lock = threading.Lock() # midi in adds while the clock thread runs
+        self.note_events = TimingWheel()
+        # lists, not sets, so an add is one append. Events that went out or were cancelled stay listed
+        # until compact drops them, pending says which are still live
+        self.by_key = {} # channel << 7 | note: list of events
+        self.by_owner = {} # owner: list of events
+        self.indexed = 0 # events added since the last compact
+        self.stale = 0 # of those, ones no longer pending
+        self.cancelled = 0 # cancelled events still sitting in the wheel
+        self.generation = 0 # bumped by purge so old handles cannot cancel
         self.midiout = None
+        # so we can see when we fall behind
+        self.batches = 0
+        self.max_batch = 0
+        self.late_events = 0 # sent on a later tick than asked for
+        self.max_late_ticks = 0
 
     def run(self, tick, midiout):
         """
-        See if any events are ready to play
+        Send every event due at or before tick as one batch
         """
-        if self.note_events is None:
+        events = self.take(tick)
+        if not events:
             return
 
-        if self.note_events.empty():
-            return
+        late = tick - events[0][0]
+        if late > 0:
+            self.late_events += sum(1 for event in events if event[0] < tick)
+            if late > self.max_late_ticks:
+                self.max_late_ticks = late
 
-        # no peek ;(
-        event = self.note_events.get()
+        #log.info(f"Run: {tick}")
+        midiout.send_messages([event[1] for event in events])
+        self.midiout = midiout
 
-        if tick >= event[0]:
-            #log.info(f"Run: {tick}")
-            midiout.send_message(event[1])
-        else:
-            self.note_events.put(event)
+    def take(self, tick):
+        """
+        remove every event due at or before tick and return them as (tick, message)
+        in the order they should go out, for a caller that sends them itself.
+        A take further ahead leaves later events in due, they stay there until their tick is asked for
+        """
+        with self.lock:
+            self.note_events.advance(tick)
+            due = self.note_events.due
+            if not due:
+                return []
+
+            events = [] # (tick, message)
+            later = [] # due in the wheel but after tick
+            while due:
+                entry = due.popleft()
+                event = entry[1]
+                if event.pending == False:
+                    self.cancelled -= 1
+                    continue
+
+                if entry[0] > tick:
+                    later.append(entry)
+                    continue
+
+                if event.expander is None:
+                    event.pending = False
+                    self.stale += 1
+                    events.append((event.tick, event.message))
+                    continue
+
+                message, next_tick = event.expander.expand()
+                if message is not None:
+                    events.append((event.tick, message))
+
+                if next_tick is None:
+                    event.pending = False
+                    self.stale += 1
+                    continue
+
+                # same handle goes back in, a next tick already due lands in due and we get it this pass
+                event.tick = next_tick
+                self.note_events.insert(next_tick, event)
+
+            due.extend(later)
+            self.compact()
+
+        if not events:
+            return events
+
+        # in tick order and within a tick note offs go first so a repeated note is not cut short
+        events.sort(key=lambda event: (event[0], message_is_note_off(event[1]) == False))
+
+        self.batches += 1
+        if len(events) > self.max_batch:
+            self.max_batch = len(events)
+
+        return events
+
+    def next_due(self, limit):
+        """
+        tick of the next event before limit or None, so a clock can wait for it between its own ticks
+        """
+        with self.lock:
+            return self.note_events.next_due(limit)
 
-        self.midiout = midiout
+    def get_stats(self):
+        return {'pending': len(self.note_events) - self.cancelled,
+                'batches': self.batches,
+                'max_batch': self.max_batch,
+                'late_events': self.late_events,
+                'max_late_ticks': self.max_late_ticks}
 
-    def add(self, tick, message):
+    def add(self, tick, message, owner=None):
         """
-        Add a message to the priority queue
+        Add a message to the timing wheel, returns a handle to cancel it
         """
-        self.note_events.put((tick, message))
+        with self.lock:
+            event = NoteEvent(tick, message, owner, self.generation)
+            self.note_events.insert(tick, event)
+            self.index(event)
         #log.info(f"Add: {message}, {tick}")
+        return event
+
+    def add_expander(self, tick, key, expander, owner=None):
+        """
+        Add one entry that makes its own messages as it comes due,
+        expander.expand() returns (message or None to send nothing this time, next tick or None when finished)
+        key is (channel, note) so cancel_note finds it
+        """
+        with self.lock:
+            event = NoteEvent(tick, None, owner, self.generation, expander, (key[0] << 7) | key[1])
+            self.note_events.insert(tick, event)
+            self.index(event)
+        return event
+
+    def index(self, event):
+        self.indexed += 1
+        key = event.key
+        if key is not None:
+            events = self.by_key.get(key)
+            if events is None:
+                self.by_key[key] = [event]
+            else:
+                events.append(event)
+
+        owner = event.owner
+        if owner is not None:
+            events = self.by_owner.get(owner)
+            if events is None:
+                self.by_owner[owner] = [event]
+            else:
+                events.append(event)
+
+    def compact(self):
+        """
+        drop events that are no longer pending from the indexes once they make up most of them,
+        each pass is paid for by the adds before it
+        """
+        if self.stale < 1024 or self.stale * 2 < self.indexed:
+            return
+
+        for index in (self.by_key, self.by_owner):
+            for key in list(index):
+                events = [event for event in index[key] if event.pending]
+                if events:
+                    index[key] = events
+                else:
+                    del index[key]
+        self.indexed -= self.stale
+        self.stale = 0
+
+    def cancel_events(self, events):
+        # the wheel entry stays put and is skipped when it comes due
+        for event in events:
+            if event.pending == False or event.generation != self.generation:
+                continue
+            event.pending = False
+            self.cancelled += 1
+            self.stale += 1
+
+    def cancel(self, event):
+        """
+        O(1), returns False if it already went out or was cancelled
+        """
+        with self.lock:
+            if event.pending == False or event.generation != self.generation:
+                return False
+            self.cancel_events((event,))
+        return True
+
+    def cancel_note(self, channel, note):
+        """
+        cancel everything pending for this channel and note, returns the cancelled events
+        """
+        with self.lock:
+            events = [event for event in self.by_key.pop((channel << 7) | note, ()) if event.pending]
+            self.cancel_events(events)
+            self.compact()
+        return events
+
+    def cancel_owner(self, owner):
+        """
+        cancel everything added by owner, returns the cancelled events
+        """
+        with self.lock:
+            events = [event for event in self.by_owner.pop(owner, ()) if event.pending]
+            self.cancel_events(events)
+            self.compact()
+        return events
 
     def purge(self):
-        self.note_events = None
-        self.note_events = queue.PriorityQueue()
+        with self.lock:
+            self.note_events = TimingWheel(self.note_events.now)
+            self.by_key = {}
+            self.by_owner = {}
+            self.indexed = 0
+            self.stale = 0
+            self.cancelled = 0
+            self.generation += 1
 
     def panic(self):
-        self.note_events = None
-        self.note_events = queue.PriorityQueue()
+        self.purge()
 
     def is_empty(self):
-        return self.note_events.empty()
-
+        return len(self.note_events) - self.cancelled == 0
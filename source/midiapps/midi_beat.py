@@ -17,7 +17,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
-from common.midi import MidiNoteMessage, MidiMessage, MidiConstants, note_to_midi_number, NOTES, MIN_OCTAVE, MAX_OCTAVE
+from common.midi import MidiNoteMessage, MidiMessage, MidiConstants, note_to_midi_number, NOTES, NOTE_INDEX, MIN_OCTAVE, MAX_OCTAVE, DIVISION_SIXTEENTH, VOICE_PLAYED
 from midiapps.midi_effect_manager import Effect
 
 # uses a beat selector in UI to select a beat. 
@@ -231,23 +231,13 @@ class BeatManager:
     def __init__(self):
         self.mute = True
         self.beats = []
-        self.midiout = None
-        self.tick_count = 0
 
     def run(self, tick, midiout):
         """
         See if any events are ready to play
-        called at clock rate
+        called every 6 ticks, the clock bus only calls us on those
+        midiout may be the dispatcher's DispatchOut, so it is not kept for panic
         """
-        self.midiout = midiout
-
-        # we only want to process events every 6 ticks
-        self.tick_count += 1
-        if self.tick_count != 6:
-            return
-
-        self.tick_count = 0
-
         if self.mute == True:
             return
 
@@ -285,11 +275,11 @@ class BeatManager:
     def purge(self, midiout):
         self.purge_beats(midiout)
         
-    def panic(self):
-        self.purge_beats(self.midiout)
+    def panic(self, midiout):
+        self.purge_beats(midiout)
 
     def is_empty(self):
-        return True
+        return self.mute # beats play every bar while on
 
 
 
@@ -298,7 +288,8 @@ class MidiBeatEffect(Effect):
     def __init__(self, settings, cc_controls=None):
         super().__init__(settings, cc_controls)
         self.name = 'Beat'
-        self.note_manager = BeatManager() # called every tick to play scheduled notes
+        self.note_manager = BeatManager() # called every 6 ticks to play scheduled notes
+        self.clock_division = DIVISION_SIXTEENTH
         # we have N beats going on all at once. 
         self.update_beat_index = self.settings.get('BeatEffectBeatSelect', 1) # set via UI to beat index that can be updated 1 - 8
         if self.update_beat_index == 0:
@@ -359,14 +350,17 @@ class MidiBeatEffect(Effect):
     def panic(self):
         """
         All active notes are turned off
+        the dispatcher is emptied first, note offs queued there would be purged too
         """
-        self.note_manager.panic()
+        self.purge_dispatcher()
+        self.note_manager.panic(self.midiout)
 
     def purge(self, midiout):
         """
         override Effect as a mute
         called when effect disabled (or Mute button off)
         """
+        self.purge_dispatcher() # or queued beats play after the note offs
         self.note_manager.purge(midiout)
 
     def add_controls(self):
@@ -476,7 +470,7 @@ class MidiBeatEffect(Effect):
                 continue
 
             if name == 'Note':
-                value = NOTES.index(value)
+                value = NOTE_INDEX[value]
 
             ui_callback(value, ui_name)
 
@@ -578,5 +572,5 @@ class MidiBeatEffect(Effect):
         """
         note events are not used
         """
-        midiout.send_message(message)  # send original note event
+        midiout.send_message(message, VOICE_PLAYED)  # send original note event
 
@@ -18,8 +18,9 @@ log = logging.getLogger(__name__)
 
 from common.midi import *
 from common.upper_class_utils import NoteManager
+from common.timing import HybridWaiter, set_thread_realtime, NS_PER_SEC
 from midiapps.midi_effect_manager import Effect
-from common.midi import MidiNoteMessage, MidiConstants
+from common.midi import MidiConstants
 
 
 def fatal_exit(msg):
@@ -119,9 +120,10 @@ class MidiChordEffect(Effect):
         self.new_chord_index = self.chord_index
         self.chord_width = self.settings.get('ChordEffectWidth', 3) # triad
         self.new_chord_width = self.chord_width
+        self.held_chords = {} # (channel, tonic): notes its note on played, so the note off matches
 
         # for strum
-        self.strummer = Strummer()
+        self.strummer = Strummer(self.settings)
         strum_delay = self.settings.get('ChordEffectStrumDelay', 0) # 0 = no strum
         if strum_delay:
             self.strummer.set_delay(strum_delay)
@@ -139,6 +141,7 @@ class MidiChordEffect(Effect):
         cancels all future notes
         """
         self.strummer.stop()
+        self.held_chords.clear()
            
 
     def get_chord_name_label(self, index):
@@ -221,33 +224,62 @@ class MidiChordEffect(Effect):
         #log.info(f"Chord strum delay: {control}")
 
 
+    def chord_notes(self, tonic):
+        """
+        the other notes of the current chord, empty if it cannot be made
+        """
+        try:
+            chord = MidiChord(tonic=tonic, name=self.chord_names[self.chord_index], width=self.chord_width)
+        except:
+            return []
+
+        return chord.notes()
+
     def run(self, tick, midiout, message):
         """
         generate the added notes for the chord
         """
-        # if we change in the middle of a chord playing we get stuck notes
+        # chords already sounding keep their notes so a change here cannot leave stuck notes
         if self.chord_index != self.new_chord_index or self.chord_width != self.new_chord_width:
             self.chord_index = self.new_chord_index
             self.chord_width = self.new_chord_width
-            self.strummer.purge()
-            self.purge(midiout) # turns off pending notes. 
-
-        midiout.send_message(message)  # send original note event
-
-        onote = MidiNoteMessage(message)
-        try:
-            chord = MidiChord(tonic=onote.note, name=self.chord_names[self.chord_index], width=self.chord_width)
-        except:
-            return
 
+        channel = (message >> 16) & 0x0F # packed, see pack_message
+        tonic = (message >> 8) & 0x7F
+        key = (channel, tonic)
+        if (message >> 16) & 0xF0 == NOTE_ON and message & 0x7F > 0:
+            notes = self.chord_notes(tonic)
+            self.held_chords[key] = notes
+            if self.strummer.is_running() == True:
+                # a re-struck chord cancels only its own pending strum notes, they are added with it as owner
+                first = {} # note: its earliest cancelled event
+                for event in self.strummer.cancel_owner(key):
+                    note = (event.message >> 8) & 0x7F
+                    if note not in first or event.tick < first[note].tick:
+                        first[note] = event
+                for event in first.values():
+                    if event.is_note_off():
+                        # next due was an off so this note is sounding
+                        if self.add_note_on_event(event.message):
+                            midiout.send_message(event.message)
+        else:
+            notes = self.held_chords.pop(key, None)
+            if notes is None:
+                notes = self.chord_notes(tonic)
+
+        midiout.send_message(message, VOICE_PLAYED)  # send original note event
+
+        status = message >> 16
+        velocity = message & 0x7F
         num = 1
-        for note in chord.notes():
-            onote.note = note
-            message = onote.get_message()
-            self.add_note_on_event(message) # keeps track of note on events if we need to purge
+        for note in notes:
+            message = note_message(status, note, velocity) # shared, nothing made
+            # keeps track of note on events if we need to purge
+            if self.add_note_on_event(message) == False:
+                continue # another chord still holds this note
 
             if self.strummer.is_running() == True:
-               self.strummer.add(num, message, midiout)
+               self.strummer.add(num, message, midiout, owner=key)
                num += 1
             else:
                 midiout.send_message(message)
@@ -259,42 +291,68 @@ class Strummer:
     fires off a thread to play delayed strum notes
     Runs at 10 msec intervals
     """
-    def __init__(self):
-        
+    def __init__(self, settings=None):
+        self.settings = settings # only for thread priority and tickless
         self.tick_time = 0.01 # 10 msec
+        self.tick_period_ns = round(self.tick_time * NS_PER_SEC)
         self.running = False
         self.note_manager = NoteManager() 
         self.midiout = None
         self.tick = 0
+        self.anchor_ns = time.perf_counter_ns() # tick 0
         self.delay_ticks = 0
+        self.waiter = HybridWaiter()
+        # with nothing to strum the thread blocks until add wakes it
+        self.tickless = True
+        if self.settings is not None:
+            self.tickless = self.settings.get('TicklessIdle', True)
+        self.wake_event = threading.Event()
 
     def set_delay(self, ticks):
         self.delay_ticks = ticks
 
-    def add(self, num, message, midiout):
-        play_tick = self.tick + (num * self.delay_ticks)
+    def current_tick(self):
+        # from the clock, not the thread, so it is right even while the thread sleeps
+        return (time.perf_counter_ns() - self.anchor_ns) // self.tick_period_ns
+
+    def add(self, num, message, midiout, owner=None):
+        """
+        owner is what cancel_owner finds it by, the chord's (channel, tonic)
+        """
+        play_tick = self.current_tick() + (num * self.delay_ticks)
         #log.info(f'Strummer add: {play_tick}')
-        self.note_manager.add(play_tick, message)
         self.midiout = midiout
+        self.note_manager.add(play_tick, message, owner)
+        self.wake_event.set()
 
     def thread(self):
+        set_thread_realtime('Strummer', self.settings)
+        self.anchor_ns = time.perf_counter_ns()
+        n = 0
         while True:
             if self.running == False:
                 #log.info('Exiting Strummer')
                 return # exit thread
 
-            start = time.perf_counter()
+            self.tick = n
+            self.note_manager.run(n, self.midiout)
 
-            self.note_manager.run(self.tick, self.midiout)
-            self.tick += 1 # count forever
-            
-            time_to_sleep = self.tick_time - (time.perf_counter() - start) # subtract off time we worked
-            if time_to_sleep < 0.0:
+            if self.tickless and self.note_manager.is_empty():
+                self.wake_event.clear()
+                if self.note_manager.is_empty() and self.running:
+                    self.wake_event.wait()
+                n = self.current_tick() # tick count stays exact across the sleep
+                continue
+
+            # deadlines are absolute so the strum spacing does not drift
+            n += 1
+            deadline = self.anchor_ns + (n * self.tick_period_ns)
+            if deadline <= time.perf_counter_ns():
                 log.error('Strummer work took too long')
-                time_to_sleep = self.tick_time # need to sleep else get stuck in this thread forever
+                continue
 
             # log.info(f'Internal clock tick: {self.tick}'
-            time.sleep(time_to_sleep)
+            self.waiter.wait_until(deadline)
 
     def run(self):
         #log.info('Starting Strummer ')
@@ -305,10 +363,17 @@ class Strummer:
     def is_running(self):
         return self.running
 
+    def cancel(self, channel, note):
+        return self.note_manager.cancel_note(channel, note)
+
+    def cancel_owner(self, owner):
+        return self.note_manager.cancel_owner(owner)
+
     def purge(self):
         self.note_manager.purge()
 
     def stop(self):
         self.purge()
         self.running = False
+        self.wake_event.set()
 
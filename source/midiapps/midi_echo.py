@@ -17,7 +17,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 logging.basicConfig(level=logging.ERROR)
 log = logging.getLogger(__name__)
 
-from common.midi import MidiNoteMessage, MidiConstants
+from common.midi import MidiConstants, CC_MAX, NOTE_ON, PULSES_PER_TICK, VOICE_PLAYED, note_off_message, note_on_row, note_message
 from common.upper_class_utils import NoteManager
 from midiapps.midi_effect_manager import Effect
 
@@ -27,12 +27,14 @@ class MidiEchoEffect(Effect):
         super().__init__(settings, cc_controls)
         self.name = 'Echo'
         self.note_manager = NoteManager()
+        self.pulses_per_tick = PULSES_PER_TICK # echoes are timed finer than the clock
         self.update = True # set if we need to update delays
         self.delay_start_ticks = self.settings.get('EchoEffectDelayStartTicks',24) # this is a quarter note
         self.delay_types = ['LINEAR', 'EXP SLOW', 'EXP FAST']   # seen in ui
         self.delay_type = self.settings.get('EchoEffectDelayType', 0) 
-        self.delays = []    # a list of ticks for each echo (number of echoes)
+        self.delays = []    # a list of pulses for each echo (number of echoes)
         self.new_delays = self.delays
+        self.held_delays = {} # (channel, note): delays its note on echoed with, so the note off matches
         self.echoes = self.settings.get('EchoEffectNumberEchoes', 3)
         self.end_velocity = self.settings.get('EchoEffectEndVelocity', 10) # we linear ramp velocity down to this level
         self.calc_delays() # init echoes
@@ -46,7 +48,9 @@ class MidiEchoEffect(Effect):
         """
         cancels all echoes
         """
-        self.update = True # catches this in run and purges pending notes. 
+        self.note_manager.purge()
+        self.held_delays.clear()
+        self.purge(None)
 
     def get_delay_type_label(self, index):
         if index >= len(self.delay_types):
@@ -90,12 +94,11 @@ class MidiEchoEffect(Effect):
         and return it in a list, this the number of echoes and the delay of each
         """
         delay_type_str = self.delay_types[self.delay_type]
-        self.update = True
+        self.update = True # picked up by the next note, notes already echoing keep their delays
         self.new_delays = []
-        self.panic()    # stop all ongoing notes to start fresh with new parms (might be an option)
         if delay_type_str is 'LINEAR':
             for i in range(self.echoes):
-                self.new_delays.append((i+1) * self.delay_start_ticks)
+                self.new_delays.append((i+1) * self.delay_start_ticks * self.pulses_per_tick)
             return
 
         if 'EXP' in delay_type_str:
@@ -105,7 +108,7 @@ class MidiEchoEffect(Effect):
             for i in range(self.echoes):
                 v = 0.2 + ((i+1) * a)
                 f = (1.61 + math.log(v))/2.996
-                delay = round(self.delay_start_ticks * f)
+                delay = round(self.delay_start_ticks * self.pulses_per_tick * f) # not rounded to a whole tick
                 self.new_delays.append(delay)
 
             if 'SLOW' in delay_type_str:
@@ -163,37 +166,90 @@ class MidiEchoEffect(Effect):
     def run(self, tick, midiout, message):
         """
         note events are added to note manager at future times
+        tick is in pulses, see pulses_per_tick
         """
-        midiout.send_message(message)  # send original note event
+        channel = (message >> 16) & 0x0F # packed, see pack_message
+        note = (message >> 8) & 0x7F
+        key = (channel, note)
 
-        note = MidiNoteMessage(message)
-        end_velocity = self.end_velocity
-        if note.velocity <= end_velocity:
-            end_velocity = note.velocity
-
-        # if we change number of echoes in the middle of echoing notes
-        # we could miss note off events. 
         if self.update:
-            self.purge(midiout) # turns off pending notes. 
-            self.note_manager.purge()
             self.delays = self.new_delays
             self.update = False
 
-        #log.info(f'Tick: {tick}, msg: {message}')
-        # divide the velocity range to get to min from original v
-        ov = note.velocity
-        dv = (ov - end_velocity)/float(len(self.delays))
-        for i, delay in enumerate(self.delays):
-            note.velocity = round(ov - ((i + 1) * dv))
+        if (message >> 16) & 0xF0 == NOTE_ON and message & 0x7F > 0:
+            # a re-struck note cuts off its own old echo tail and nothing else
+            self.cancel_note(channel, note)
+            # its echoes that are sounding, overlapping ones too, are turned off now
+            for n in range(self.forget_note(channel, note)):
+                midiout.send_message(note_off_message(message))
 
-            if note.velocity > MidiConstants().CC_MAX:
-                note.velocity = MidiConstants().CC_MAX
+            delays = self.delays
+            self.held_delays[key] = delays
+        else:
+            # echo the note off with the same delays its note on had
+            delays = self.held_delays.pop(key, self.delays)
 
-            if note.velocity < end_velocity:
-                break
+        midiout.send_message(message, VOICE_PLAYED)  # send original note event
 
-            self.add_note_on_event(note.get_message()) # keeps track of note on events if we need to purge
-            self.note_manager.add(delay + tick, note.get_message())
-            
+        if not delays:
+            return
 
+        #log.info(f'Tick: {tick}, msg: {message}')
+        # one entry per note, it makes each echo as it comes due
+        echo = EchoTemplate(self, message, tick, delays, self.end_velocity)
+        self.note_manager.add_expander(echo.first_tick(), key, echo, owner=self)
+
+
+class EchoTemplate:
+    """
+    the echoes of one note, the source note, delay table and velocity ramp.
+    Scheduled as a single NoteManager entry which expands into the next echo
+    when it comes due and then reschedules itself for the one after.
+    """
+    __slots__ = ('effect', 'status', 'note', 'row', 'tick', 'delays', 'velocity', 'dv', 'end_velocity', 'index')
+
+    def __init__(self, effect, message, tick, delays, end_velocity):
+        self.effect = effect
+        # small ints so holding them costs nothing, each echo comes from the shared tables
+        self.status = message >> 16
+        self.note = (message >> 8) & 0x7F
+        self.row = None
+        if self.status & 0xF0 == NOTE_ON:
+            self.row = note_on_row(self.status & 0x0F, self.note) # by velocity
+        self.tick = tick # of the source note
+        self.delays = delays # shared with the effect, not copied
+        velocity = message & 0x7F
+        if velocity <= end_velocity:
+            end_velocity = velocity
+        self.end_velocity = end_velocity
+        # divide the velocity range to get to min from original v
+        self.velocity = velocity
+        self.dv = (velocity - end_velocity)/float(len(delays))
+        self.index = 0
+
+    def first_tick(self):
+        return self.tick + self.delays[0]
 
+    def expand(self):
+        """
+        returns the echo message now due, None if nothing to send, and the tick of the next, None when done
+        """
+        velocity = round(self.velocity - ((self.index + 1) * self.dv))
+        if velocity > CC_MAX:
+            velocity = CC_MAX
+
+        if velocity < self.end_velocity:
+            return None, None
+
+        if self.row is not None:
+            message = self.row[velocity]
+        else:
+            message = note_message(self.status, self.note, velocity)
+        # keeps track of note on events if we need to purge
+        if self.effect.add_note_on_event(message) == False:
+            message = None # an off for a note another echo still holds
+        self.index += 1
+        if self.index == len(self.delays):
+            return message, None
+
+        return message, self.tick + self.delays[self.index]
@@ -9,11 +9,14 @@
 import os
 import sys
 import logging
+import threading
+from array import array
 
 logging.basicConfig(level=logging.ERROR)
 log = logging.getLogger(__name__)
 
-from common.midi import MidiNoteMessage, MidiConstants
+from common.midi import MidiConstants, MidiDispatcher, NOTE_ON, NOTE_OFF, DIVISION_TICK, VOICE_PLAYED, VOICE_GENERATED, NOTE_OFF_MESSAGES
+from common.timing import HybridWaiter, NS_PER_SEC
 
 
 
@@ -26,59 +29,109 @@ class Effect:
         self.name = 'MIDI Effect'
         self.cc_controls = cc_controls
         self.note_manager = None
+        # note_manager times are in clock ticks split this finely, see PULSES_PER_TICK
+        self.pulses_per_tick = 1
+        self.clock_division = DIVISION_TICK # our clock callback runs every this many ticks
+        self.dispatcher = None # set by the effect manager if notes are sent ahead of time
+        self.midiout = None # set by the effect manager, the real output for panics, never a DispatchOut
         # this for purge, any effect that creates notes adds them here.
         # purge will send their note offs. Typically used for turning effect off in the middle
-        self.note_on_events = set([])
+        # note ons not yet turned off per channel and note, index is channel << 7 | note
+        self.note_counts = bytearray(16 * 128)
+        self.active_notes = array('H') # indexes with a count, so purge only visits those
+        self.active_slots = array('H', [0]) * (16 * 128) # where each is in active_notes
+        self.notes_lock = threading.Lock() # input, clock and strum threads all make notes
 
     def add_note_on_event(self, message):
-        # keep a set of note on events pending, if the effect is turened off we can purge them
-        # if a note off event we remove the note from the set
-        #log.info(f'add_note_on_event msg: {message}')
-        
-        try:
-            note = MidiNoteMessage(message)
-        except:
-            log.debug('add_note_on_event message error')
-            return
-
-        if note.is_note_off():
-            note.make_note_on() # notes are stored as on
-            event = (note.type_channel, note.note)
-            #log.info(f'note off event: {event}')
-            if event in self.note_on_events:
-               # log.info(f'note off remove event: {event}')
-                self.note_on_events.remove(event)
-            return
+        """
+        count the note ons we send so purge can turn them off.
+        returns false for a note off that need not be sent, the note is on more than once
+        and another of ours still holds it
+        """
+        data_type = (message >> 16) & 0xF0
+        if data_type != NOTE_ON and data_type != NOTE_OFF:
+            return True
+
+        index = ((message >> 9) & 0x0780) | ((message >> 8) & 0x7F) # channel << 7 | note
+        with self.notes_lock:
+            count = self.note_counts[index]
+            if data_type == NOTE_ON and message & 0x7F > 0:
+                if count == 0:
+                    self.active_slots[index] = len(self.active_notes)
+                    self.active_notes.append(index)
+                if count < 255:
+                    self.note_counts[index] = count + 1
+                return True
+
+            if count == 0:
+                return True # not one of ours, let it through
+            self.note_counts[index] = count - 1
+            if count > 1:
+                return False
+
+            self.remove_active(index)
+            return True
+
+    def remove_active(self, index):
+        # last in takes the place of the one going, notes_lock held
+        slot = self.active_slots[index]
+        last = self.active_notes.pop()
+        if last != index:
+            self.active_notes[slot] = last
+            self.active_slots[last] = slot
+
+    def forget_note(self, channel, note):
+        """
+        stop counting channel and note and return how many note ons of ours it had,
+        the caller sends that many note offs so the output's count ends at 0 as well
+        """
+        index = (channel << 7) | note
+        with self.notes_lock:
+            count = self.note_counts[index]
+            if count == 0:
+                return 0
+            self.note_counts[index] = 0
+            self.remove_active(index)
+        return count
+
+    def is_note_on_event(self, channel, note):
+        """
+        true if we sent a note on for channel and note and have not turned it off
+        """
+        return self.note_counts[(channel << 7) | note] > 0
 
-        # events are unique by note and channel
-        event = (note.type_channel, note.note)
+    def cancel_note(self, channel, note):
+        """
+        cancel what is scheduled for channel and note, including anything already handed to the dispatcher
+        """
+        if self.dispatcher is not None:
+            self.dispatcher.cancel_note(channel, note)
+        return self.note_manager.cancel_note(channel, note)
 
-        #log.info(f'note on add event: {event}')
-        self.note_on_events.add(event)
+    def purge_dispatcher(self):
+        if self.dispatcher is not None:
+            self.dispatcher.purge()
 
     def purge(self, midiout):
-        if midiout is None:
-            self.note_on_events.clear()
-            return
+        if self.note_manager is not None:
+            # scheduled notes would turn back on after we send the offs
+            self.note_manager.cancel_owner(self)
+        self.purge_dispatcher()
 
-        try:
-            # saw an exception where someone was modifying this set whilst iterating over it below. 
-            purge_events = self.note_on_events.copy()
-            self.note_on_events.clear()
-        except:
-            log.debug('exception copying purge events')
-            return
+        with self.notes_lock:
+            active_notes = self.active_notes
+            for index in active_notes:
+                self.note_counts[index] = 0
+            self.active_notes = array('H')
 
+        if midiout is None:
+            return
 
-        for event in purge_events:
-            message = [event[0], event[1], 0]
-            note = MidiNoteMessage(message)
-            note.make_note_off()
-            #log.info(f'Purging: {message} ')
-            midiout.send_message(message)
+        for index in active_notes:
+            #log.info(f'Purging: {index} ')
+            midiout.send_message(NOTE_OFF_MESSAGES[index])
 
         #log.info('Purge finished')
-        purge_events.clear()
 
 
     def get_name(self):
@@ -100,6 +153,15 @@ class MidiEffectManager:
         self.settings = settings
         self.midi_manager = midi_manager      
         self.effect = effect
+        self.waiter = HybridWaiter() # for notes due between clock ticks
+        # clock driven notes go to the dispatcher this far ahead and it sends them when due, 0 sends them from the clock
+        self.lookahead_ns = self.settings.get('DispatchLookaheadMs', 5) * NS_PER_SEC // 1000
+        self.dispatcher = None
+        if self.lookahead_ns > 0:
+            self.dispatcher = MidiDispatcher(self.midi_manager.midiout, settings)
+        self.effect.dispatcher = self.dispatcher
+        self.effect.midiout = self.midi_manager.midiout
+        self.clock_subscription = None
         self.effect_enable(self.settings.get('EffectEnabled', False))
         # button CCs are mapped to to enable (for example) the effect
         self.midi_manager.cc_controls.add(name='EffectEnableControlCC', cc_default=48, type='switch', control_callback=self.effect_enable)
@@ -119,7 +181,14 @@ class MidiEffectManager:
 
     def run(self):
         self.midi_manager.register_note_callback(self.note_callback)
-        self.midi_manager.register_clock_callback(self.clock_callback)
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+        division = self.effect.clock_division
+        phase = 0
+        if self.dispatcher is not None and self.effect.pulses_per_tick == 1:
+            phase = division - 1 # a tick early so the dispatcher can send on the boundary, see clock_callback
+        self.clock_subscription = self.midi_manager.subscribe_clock(self.clock_callback, division=division,
+                                                                    phase=phase, idle_callback=self.clock_idle)
         self.midi_manager.midiin.run()
         log.info('Running')
 
@@ -129,7 +198,7 @@ class MidiEffectManager:
         and may add note events to the note manager to play in the future
         """
         if self.effect_enabled == False:
-            self.midi_manager.midiout.send_message(message)  # send original note event
+            self.midi_manager.midiout.send_message(message, VOICE_PLAYED)  # send original note event
             return
 
         self.effect.run(tick, self.midi_manager.midiout, message)
@@ -141,19 +210,102 @@ class MidiEffectManager:
         """ 
         tick = 0
         if clock_source is not None:
-            tick = clock_source.get_tick()
+            tick = clock_source.get_time(self.effect.pulses_per_tick)
         #log.info(f"Note callback: {message}, {tick}")
         self.apply_effect(tick, message)         # may add  note events for the future
-        if self.effect.note_manager is not None:
-            self.effect.note_manager.run(tick, self.midi_manager.midiout)        
+        if self.effect.note_manager is None or self.effect.clock_division != DIVISION_TICK:
+            return # coarser note managers only run on their clock boundaries
+
+        if self.dispatcher is not None and self.effect.pulses_per_tick > 1 and clock_source is not None:
+            # echoes due before the clock next comes round are ours to hand over, each at its own pulse
+            self.dispatch_pulses(clock_source, clock_source.get_tick())
+            return
+
+        self.effect.note_manager.run(tick, self.midi_manager.midiout)
 
 
-    def clock_callback(self, tick, data):
+    def clock_callback(self, tick, data, skipped=0):
         """
         called at midi clock intervals or at 60 bpm every 42 msec - 24 times per quarter note
+        or every clock_division ticks for effects that ask for fewer.
         here we run the note manager and it sends or stops notes as queued
         This runs quite fast so no delays...
+        skipped is how many of our calls the clock folded into this one when it was overloaded
         """
         #log.info(f"Clock callback: {tick}")
-        self.effect.note_manager.run(tick, self.midi_manager.midiout)
-    
+        note_manager = self.effect.note_manager
+        if note_manager is None:
+            return
+
+        pulses = self.effect.pulses_per_tick
+        clock = self.midi_manager.clock
+        if self.dispatcher is not None and clock is not None:
+            if pulses > 1:
+                self.dispatch_pulses(clock, tick)
+                return
+
+            # whole tick effects make the next tick's notes now and the dispatcher holds them till then
+            note_manager.run(tick + 1, DispatchOut(self.dispatcher, clock.pulse_to_ns(tick + 1, 1)))
+            return
+
+        note_manager.run(tick * pulses, self.midi_manager.midiout)
+        if pulses > 1 and clock is not None and clock.fine_timing:
+            self.run_pulses(clock, (tick + 1) * pulses)
+
+    def dispatch_pulses(self, clock, tick):
+        """
+        hand the dispatcher everything due before the next tick plus the lookahead,
+        each at the time of its own pulse so what we spend in here is not heard
+        """
+        pulses = self.effect.pulses_per_tick
+        period = clock.get_tick_period_ns()
+        horizon = ((tick + 1) * pulses) + ((self.lookahead_ns * pulses) // period)
+        events = self.effect.note_manager.take(horizon)
+        start = 0
+        for i in range(1, len(events) + 1):
+            if i == len(events) or events[i][0] != events[start][0]:
+                pulse = events[start][0]
+                self.dispatcher.send_at(clock.pulse_to_ns(pulse, pulses), [event[1] for event in events[start:i]])
+                start = i
+
+    def run_pulses(self, clock, end):
+        """
+        play notes due between this tick and the next as their pulse comes round.
+        Clocks that can not wait in their callback play them on the next tick instead
+        """
+        note_manager = self.effect.note_manager
+        pulses = self.effect.pulses_per_tick
+        while True:
+            pulse = note_manager.next_due(end)
+            if pulse is None:
+                return
+
+            self.waiter.wait_until(clock.pulse_to_ns(pulse, pulses))
+            note_manager.run(pulse, self.midi_manager.midiout)
+
+    def get_dispatch_stats(self):
+        if self.dispatcher is None:
+            return None
+        return self.dispatcher.get_stats()
+
+    def clock_idle(self):
+        """
+        nothing scheduled so the clock need not tick until a note comes in
+        """
+        return self.effect.note_manager is None or self.effect.note_manager.is_empty()
+
+
+class DispatchOut:
+    """
+    looks like a MidiOutput to a note manager, but hands what it sends to the dispatcher for later
+    """
+    def __init__(self, dispatcher, deadline_ns):
+        self.dispatcher = dispatcher
+        self.deadline_ns = deadline_ns
+
+    def send_message(self, message, priority=VOICE_GENERATED):
+        # only generated notes are sent ahead, the output treats them all as that
+        self.dispatcher.send_at(self.deadline_ns, [message])
+
+    def send_messages(self, messages, priority=VOICE_GENERATED):
+        self.dispatcher.send_at(self.deadline_ns, messages)
@@ -0,0 +1,44 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+
+ This file compares tick jitter of the clock backends
+
+ This file can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import sys
+import os
+import time
+import logging
+import statistics
+
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from common.timing import make_ticker, CLOCK_BACKENDS
+
+BPM = 300
+TICKS = 1000
+period_ns = round(60 * 1000000000 / (BPM * 24))
+
+def run(backend):
+    ticker = make_ticker(backend)
+    lateness = []
+    ticker.start(period_ns)
+    cpu_start = time.thread_time()
+    for t in range(TICKS):
+        ticker.wait()
+        lateness.append((time.perf_counter_ns() - ticker.last_deadline_ns()) / 1000.0)
+    cpu = time.thread_time() - cpu_start
+    ticker.stop()
+
+    lateness.sort()
+    print(f'{backend:8} late usec mean: {statistics.mean(lateness):8.1f} '
+          f'p99: {lateness[int(len(lateness) * 0.99)]:8.1f} '
+          f'max: {lateness[-1]:8.1f}  cpu: {100 * cpu * 1000000000 / (TICKS * period_ns):5.1f}%')
+
+print(f'{TICKS} ticks at {BPM} BPM, period {period_ns / 1000000.0:.3f} msec')
+for backend in CLOCK_BACKENDS:
+    run(backend)
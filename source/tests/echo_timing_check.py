@@ -0,0 +1,105 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+
+ This file checks that no echo goes out before its pulse, notes come in at random
+ points between clock ticks with the dispatcher sending ahead
+
+ This file can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import sys
+import os
+import time
+import random
+import logging
+
+
+logging.basicConfig(level=logging.ERROR)
+log = logging.getLogger(__name__)
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from stubs import Settings, Manager
+from common.midi import MidiInternalClock, PULSES_PER_TICK, NOTE_ON, pack_message
+from midiapps.midi_effect_manager import MidiEffectManager
+from midiapps.midi_echo import MidiEchoEffect
+
+NOTES = 20
+BPM = 60
+SLACK_NS = 500000 # the clock's own jitter, early by more than this fails
+
+
+class RecordingOut:
+    """
+    stands in for MidiOutput, notes when each message went
+    """
+    def __init__(self):
+        self.sent = [] # (perf_counter_ns, message)
+
+    def send_message(self, message, priority=0):
+        self.sent.append((time.perf_counter_ns(), message))
+
+    def send_messages(self, messages, priority=0):
+        now = time.perf_counter_ns()
+        self.sent.extend((now, message) for message in messages)
+
+    def purge(self):
+        pass
+
+
+def check(lookahead_ms):
+    settings = Settings({'DispatchLookaheadMs': lookahead_ms, 'EffectEnabled': True, 'internal_clock_bpm': BPM,
+                         'EchoEffectDelayType': 0, 'EchoEffectNumberEchoes': 3,
+                         'EchoEffectDelayStartTicks': 1, 'EchoEffectEndVelocity': 10})
+    manager = Manager(RecordingOut(), clock=MidiInternalClock(settings))
+    effect = MidiEchoEffect(settings)
+    effect_manager = MidiEffectManager(settings, effect, manager)
+    if effect_manager.dispatcher is not None:
+        effect_manager.dispatcher.start()
+    clock = manager.clock
+    clock.register_clock_callback(effect_manager.clock_callback, idle_callback=effect_manager.clock_idle)
+    clock.start_clock()
+    pulse_ns = clock.get_tick_period_ns() // PULSES_PER_TICK
+    random.seed(lookahead_ms)
+    played = {} # note: pulse it came in on
+    try:
+        time.sleep(0.1)
+        for n in range(NOTES):
+            time.sleep(random.uniform(0.005, 0.06)) # anywhere between ticks
+            note = 40 + n
+            played[note] = clock.get_time(PULSES_PER_TICK)
+            effect_manager.note_callback(pack_message(NOTE_ON, note, 100), clock)
+            clock.wake()
+        time.sleep(0.1 + (effect.delays[-1] * pulse_ns) / 1000000000)
+        # the internal clock grid does not move at a steady tempo, so this is when each pulse was due
+        deadlines = {note: [clock.pulse_to_ns(pulse + delay) for delay in effect.delays] for note, pulse in played.items()}
+    finally:
+        clock.stop_clock()
+        if effect_manager.dispatcher is not None:
+            effect_manager.dispatcher.stop()
+
+    echoes = {} # note: send times of its echoes in order
+    for sent_ns, message in manager.midiout.sent:
+        if message & 0x7F < 100:
+            echoes.setdefault((message >> 8) & 0x7F, []).append(sent_ns)
+
+    early = 0
+    count = 0
+    for note in played:
+        times = echoes.get(note, [])
+        if len(times) != len(effect.delays):
+            print(f'note {note} sent {len(times)} echoes, expected {len(effect.delays)}')
+            early += 1
+        for delay, deadline, sent_ns in zip(effect.delays, deadlines[note], times):
+            count += 1
+            if sent_ns < deadline - SLACK_NS:
+                print(f'note {note} echo at {delay} pulses went {(deadline - sent_ns) / 1000000:.2f} msec early')
+                early += 1
+
+    print(f'lookahead {lookahead_ms} msec: {count} echoes, {early} wrong')
+    return early == 0
+
+ok = True
+for lookahead_ms in (0, 5):
+    ok = check(lookahead_ms) and ok
+print('OK' if ok else 'FAILED')
+sys.exit(0 if ok else 1)
@@ -0,0 +1,55 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+
+ This file compares idle cpu of the clock threads with and without tickless idle
+
+ This file can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import sys
+import os
+import time
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from stubs import Settings
+from common.midi import MidiInternalClock
+from midiapps.midi_chord import Strummer
+
+SECONDS = 5
+BPM = 120
+
+
+def clock_callback(tick, data, skipped=0):
+    pass
+
+def nothing_scheduled():
+    return True
+
+def idle_cpu(tickless):
+    settings = Settings({'TicklessIdle': tickless, 'internal_clock_bpm': BPM})
+    clock = MidiInternalClock(settings)
+    clock.register_clock_callback(clock_callback, idle_callback=nothing_scheduled)
+    clock.start_clock()
+    strummer = Strummer(settings)
+    strummer.set_delay(5)
+    strummer.run()
+
+    time.sleep(0.5) # let both threads settle
+    cpu_start = time.process_time()
+    tick_start = clock.get_tick()
+    time.sleep(SECONDS)
+    cpu = time.process_time() - cpu_start
+    ticks = clock.get_tick() - tick_start
+
+    strummer.stop()
+    clock.stop_clock()
+    print(f'tickless {str(tickless):5}  idle cpu: {100 * cpu / SECONDS:5.2f}%  '
+          f'clock ticks in {SECONDS} sec: {ticks} (expect {SECONDS * BPM * 24 // 60})')
+
+for tickless in (False, True):
+    idle_cpu(tickless)
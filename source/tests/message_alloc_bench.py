@@ -0,0 +1,104 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+
+ This file measures what notes cost on their way from midi in through the echo effect to midi out,
+ memory held per scheduled note and time per note
+
+ This file can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import sys
+import os
+import time
+import logging
+import tracemalloc
+
+
+logging.basicConfig(level=logging.ERROR)
+log = logging.getLogger(__name__)
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from stubs import Settings, Manager
+from common.midi import MidiInput, MidiOutput
+from midiapps.midi_effect_manager import MidiEffectManager
+from midiapps.midi_echo import MidiEchoEffect
+
+NOTES = 2000 # note on and off pairs, each its own channel and note so no echo cuts another short
+ECHOES = 8
+TICKS = 200 # echoes all done by then
+
+
+class NullPort:
+    """
+    stands in for the rtmidi port, counts what reaches it
+    """
+    def __init__(self):
+        self.sent = 0
+
+    def is_port_open(self):
+        return True
+
+    def send_message(self, message):
+        self.sent += 1
+
+    def close_port(self):
+        pass
+
+
+def run(trace):
+    """
+    timed without tracemalloc, it slows every allocation.
+    With it, transient is how far memory rose above where it ended while each message was handled,
+    what it made and let go again, held is what stays while echoes are scheduled
+    """
+    settings = Settings({'DispatchLookaheadMs': 0, 'EffectEnabled': True, 'EchoEffectNumberEchoes': ECHOES,
+                         'EchoEffectDelayStartTicks': 2, 'EchoEffectEndVelocity': 1})
+    midiout = MidiOutput()
+    midiout.midi = NullPort()
+    manager = Manager(midiout, midiin=MidiInput(settings))
+    effect_manager = MidiEffectManager(settings, MidiEchoEffect(settings), manager)
+    manager.midiin.register_note_callback(effect_manager.note_callback)
+    messages = []
+    for n in range(NOTES):
+        messages.append(([0x90 | (n // 128), n % 128, 100], 0.0))
+        messages.append(([0x80 | (n // 128), n % 128, 0], 0.0))
+
+    if not trace:
+        start = time.perf_counter()
+        for message in messages:
+            manager.midiin.callback(message, None)
+        input_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for tick in range(1, TICKS):
+            effect_manager.clock_callback(tick, None)
+        run_time = time.perf_counter() - start
+        sent = manager.midiout.midi.sent
+        print(f'{NOTES} notes, {ECHOES} echoes each, {sent} messages out')
+        print(f'in:  {1000000 * input_time / len(messages):6.2f} usec per message')
+        print(f'out: {1000000 * run_time / (sent - len(messages)):6.2f} usec per echo')
+        return
+
+    tracemalloc.start()
+    held_start = tracemalloc.get_traced_memory()[0]
+    transient = 0
+    for message in messages:
+        tracemalloc.reset_peak()
+        manager.midiin.callback(message, None)
+        after, peak = tracemalloc.get_traced_memory()
+        transient += peak - after
+    held = tracemalloc.get_traced_memory()[0] - held_start
+    print(f'in:  transient {transient / len(messages):6.1f} bytes per message, '
+          f'held while scheduled {held / len(messages):6.1f} bytes per message')
+
+    transient = 0
+    for tick in range(1, TICKS):
+        tracemalloc.reset_peak()
+        effect_manager.clock_callback(tick, None)
+        after, peak = tracemalloc.get_traced_memory()
+        transient += peak - after
+    tracemalloc.stop()
+    print(f'out: transient {transient / (manager.midiout.midi.sent - len(messages)):6.1f} bytes per echo')
+
+run(False) # first time through the shared note tables fill in
+run(False)
+run(True)
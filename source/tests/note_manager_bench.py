@@ -0,0 +1,81 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+
+ This file compares the timing wheel NoteManager to the old priority queue one
+
+ This file can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import sys
+import os
+import time
+import queue
+import random
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from common.upper_class_utils import NoteManager
+
+TICKS = 2000 # events are spread over this many ticks
+
+
+class QueueNoteManager:
+    """
+    the old priority queue NoteManager, one get/put round trip per tick
+    """
+    def __init__(self):
+        self.note_events = queue.PriorityQueue()
+
+    def run(self, tick, midiout):
+        if self.note_events.empty():
+            return
+
+        event = self.note_events.get()
+        if tick >= event[0]:
+            midiout.send_message(event[1])
+        else:
+            self.note_events.put(event)
+
+    def add(self, tick, message):
+        self.note_events.put((tick, message))
+
+
+class NullOut:
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, message):
+        self.sent += 1
+
+    def send_messages(self, messages):
+        self.sent += len(messages)
+
+
+def bench(manager, events):
+    midiout = NullOut()
+    start = time.perf_counter()
+    for tick, message in events:
+        manager.add(tick, message)
+    add_time = time.perf_counter() - start
+
+    # each tick runs until nothing more comes out, like a clock callback that keeps up
+    start = time.perf_counter()
+    for tick in range(TICKS + 1):
+        sent = -1
+        while sent != midiout.sent:
+            sent = midiout.sent
+            manager.run(tick, midiout)
+    run_time = time.perf_counter() - start
+    return add_time, run_time, midiout.sent
+
+for pending in (10000, 100000):
+    random.seed(pending)
+    events = [(random.randint(1, TICKS), (0x90 << 16) | (random.randint(0, 127) << 8) | 100) for e in range(pending)]
+    for manager in (QueueNoteManager(), NoteManager()):
+        add_time, run_time, sent = bench(manager, events)
+        print(f'{manager.__class__.__name__:16} {pending:7} events  add: {add_time * 1000:8.1f} msec  '
+              f'run {TICKS} ticks: {run_time * 1000:8.1f} msec  sent: {sent}')
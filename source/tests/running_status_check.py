@@ -0,0 +1,162 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+
+ This file checks the running status encoder, random streams from a few seeds are encoded
+ to bytes, parsed back the way a synth would and must leave it in the same state
+ as the stream itself would. Runs without rtmidi
+
+ This file can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import sys
+import os
+import random
+import logging
+
+
+logging.basicConfig(level=logging.ERROR)
+log = logging.getLogger(__name__)
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from common.midi_messages import (RunningStatusEncoder, pack_message, message_length, NOTE_ON, NOTE_OFF, CONTROL_CHANGE,
+                                  ALL_SOUND_OFF, ALL_NOTES_OFF, RESET_ALL_CONTROLLERS)
+
+SEEDS = range(10)
+MESSAGES = 5000
+
+
+class Synth:
+    """
+    what a receiver keeps, sounding notes counted like the encoder does and controller values
+    """
+    def __init__(self):
+        self.sounding = {} # (channel, note): count
+        self.controls = {} # (channel, controller): value
+
+    def is_redundant(self, message):
+        """
+        would change nothing here
+        """
+        status = message >> 16
+        data_type = status & 0xF0
+        key = (status & 0x0F, (message >> 8) & 0x7F)
+        if data_type == NOTE_OFF or (data_type == NOTE_ON and message & 0x7F == 0):
+            return key not in self.sounding
+        if data_type == CONTROL_CHANGE and key[1] < ALL_SOUND_OFF and key[1] not in RunningStatusEncoder.ALWAYS_SENT_CC:
+            return self.controls.get(key) == message & 0x7F
+        return False
+
+    def receive(self, message):
+        status = message >> 16
+        data_type = status & 0xF0
+        channel = status & 0x0F
+        data1 = (message >> 8) & 0x7F
+        if data_type == NOTE_ON and message & 0x7F > 0:
+            self.sounding[(channel, data1)] = self.sounding.get((channel, data1), 0) + 1
+        elif data_type == NOTE_ON or data_type == NOTE_OFF:
+            count = self.sounding.get((channel, data1), 0)
+            if count > 1:
+                self.sounding[(channel, data1)] = count - 1
+            elif count == 1:
+                del self.sounding[(channel, data1)]
+        elif data_type == CONTROL_CHANGE:
+            if data1 in (ALL_SOUND_OFF, ALL_NOTES_OFF):
+                for key in [key for key in self.sounding if key[0] == channel]:
+                    del self.sounding[key]
+            elif data1 == RESET_ALL_CONTROLLERS:
+                for key in [key for key in self.controls if key[0] == channel]:
+                    del self.controls[key]
+            elif data1 < ALL_SOUND_OFF:
+                self.controls[(channel, data1)] = message & 0x7F
+
+
+def parse(data, last_status):
+    """
+    bytes with running status back to packed messages, returns them and the running status after
+    """
+    messages = []
+    i = 0
+    while i < len(data):
+        status = data[i]
+        if status >= 0x80:
+            i += 1
+            if status >= 0xF8:
+                messages.append(pack_message(status))
+                continue
+            last_status = status if status < 0xF0 else None
+        elif last_status is None:
+            raise Exception(f'data byte {status} with no running status')
+        else:
+            status = last_status
+
+        length = message_length(pack_message(status)) - 1
+        body = list(data[i:i + length])
+        i += length
+        messages.append(pack_message(status, *body))
+    return messages, last_status
+
+
+def random_message(rng):
+    r = rng.random()
+    channel = rng.randint(0, 2)
+    if r < 0.4:
+        return pack_message(NOTE_ON | channel, rng.randint(60, 63), rng.randint(1, 127))
+    if r < 0.7:
+        if rng.random() < 0.5:
+            return pack_message(NOTE_ON | channel, rng.randint(60, 63), 0)
+        return pack_message(NOTE_OFF | channel, rng.randint(60, 63), rng.choice((0, 64)))
+    if r < 0.9:
+        return pack_message(CONTROL_CHANGE | channel, rng.choice((1, 6, 7, 64)), rng.choice((0, 64, 127)))
+    if r < 0.93:
+        return pack_message(CONTROL_CHANGE | channel, rng.choice((ALL_SOUND_OFF, ALL_NOTES_OFF, RESET_ALL_CONTROLLERS)))
+    if r < 0.97:
+        return pack_message(0xF8) # clock, realtime
+    return pack_message(0xF2, rng.randint(0, 127), rng.randint(0, 127)) # song position, system common
+
+
+def check(seed):
+    rng = random.Random(seed)
+    encoder = RunningStatusEncoder()
+    played = Synth() # fed what we meant to send
+    heard = Synth() # fed what came off the wire
+    last_status = None
+    wire_bytes = 0
+    in_bytes = 0
+    errors = []
+    for n in range(MESSAGES):
+        message = random_message(rng)
+        in_bytes += message_length(message)
+        played.receive(message)
+        data = encoder.encode(message)
+        wire_bytes += len(data)
+        try:
+            messages, last_status = parse(data, last_status)
+        except Exception as e:
+            errors.append(f'message {n}: {e}')
+            break
+
+        for received in messages:
+            if heard.is_redundant(received):
+                errors.append(f'message {n} {message:06x}: sent though it changes nothing')
+            heard.receive(received)
+        if heard.sounding != played.sounding or heard.controls != played.controls:
+            errors.append(f'message {n} {message:06x}: synth state differs')
+        if data and (messages[0] >> 16) & 0xF0 == NOTE_OFF and encoder.note_off_as_note_on:
+            errors.append(f'message {n}: note off not sent as note on velocity 0')
+        if len(errors) > 5:
+            break
+
+    stats = encoder.get_stats()
+    if stats['in_bytes'] != in_bytes or stats['out_bytes'] != wire_bytes:
+        errors.append(f'stats {stats}, expected in {in_bytes} out {wire_bytes}')
+    return errors, stats
+
+ok = True
+for seed in SEEDS:
+    errors, stats = check(seed)
+    for error in errors:
+        print(f'seed {seed} {error}')
+    ok = ok and not errors
+print(f'last seed: {stats}')
+print('OK' if ok else 'FAILED')
+sys.exit(0 if ok else 1)
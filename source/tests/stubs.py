@@ -0,0 +1,47 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+
+ This file holds the stand ins the clock and effect checks share. common.midi prints
+ and exits 0 without rtmidi, which would pass a check that never ran, so importing this
+ exits 1 first
+
+ This file can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import sys
+
+try:
+    import rtmidi
+except ImportError:
+    print('rtmidi not found, this check needs it')
+    sys.exit(1)
+
+
+class Settings:
+    """
+    just enough of the settings object
+    """
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, key, default=None):
+        return self.values.setdefault(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+
+class CCControls:
+    def add(self, **kwargs):
+        pass
+
+
+class Manager:
+    """
+    the parts of MidiManager the effect manager uses, clock None and we drive the ticks
+    """
+    def __init__(self, midiout, midiin=None, clock=None):
+        self.midiout = midiout
+        self.midiin = midiin
+        self.cc_controls = CCControls()
+        self.clock = clock
@@ -0,0 +1,157 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+
+ This file checks the timing wheel and the NoteManager on it against a plain sorted list,
+ random inserts, cancels and advances from a few seeds, runs without rtmidi
+
+ This file can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import sys
+import os
+import random
+import logging
+
+
+logging.basicConfig(level=logging.ERROR)
+log = logging.getLogger(__name__)
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from common.upper_class_utils import TimingWheel, NoteManager, WHEEL_SIZE, WHEEL_BITS, WHEEL_LEVELS
+
+SEEDS = range(10)
+STEPS = 5000
+# just before each level and the overflow roll over, so small steps cascade through them
+STARTS = [0] + [(1 << (WHEEL_BITS * level)) - 100 for level in range(1, WHEEL_LEVELS + 1)]
+
+
+def insert_distance(rng):
+    """
+    mostly near, some in every level, some in overflow and some already past
+    """
+    r = rng.random()
+    if r < 0.5:
+        return rng.randint(0, WHEEL_SIZE)
+    if r < 0.7:
+        return rng.randint(WHEEL_SIZE, WHEEL_SIZE << WHEEL_BITS)
+    if r < 0.8:
+        return rng.randint(WHEEL_SIZE << WHEEL_BITS, 1 << (WHEEL_BITS * WHEEL_LEVELS))
+    if r < 0.9:
+        return rng.randint(1 << (WHEEL_BITS * WHEEL_LEVELS), 1 << (WHEEL_BITS * WHEEL_LEVELS + 2))
+    return -rng.randint(0, 10)
+
+
+def check_wheel(seed, start):
+    rng = random.Random(seed)
+    wheel = TimingWheel(start)
+    pending = [] # (tick, item) not yet due
+    errors = []
+    for step in range(STEPS):
+        r = rng.random()
+        if r < 0.5:
+            tick = wheel.now + insert_distance(rng)
+            wheel.insert(tick, step)
+            pending.append((tick, step))
+        elif r < 0.97:
+            wheel.advance(wheel.now + rng.randint(1, 8))
+        else:
+            wheel.advance(wheel.now + rng.randint(WHEEL_SIZE + 1, WHEEL_SIZE << WHEEL_BITS)) # rebuckets
+
+        due = list(wheel.due)
+        wheel.due.clear()
+        expected = sorted(entry for entry in pending if entry[0] <= wheel.now)
+        pending = [entry for entry in pending if entry[0] > wheel.now]
+        if sorted(due) != expected:
+            errors.append(f'step {step}: {len(due)} due, expected {len(expected)}')
+        if len(wheel) != len(pending):
+            errors.append(f'step {step}: wheel holds {len(wheel)}, expected {len(pending)}')
+
+        limit = wheel.now + rng.randint(1, WHEEL_SIZE)
+        first = min((entry[0] for entry in pending if entry[0] < limit), default=None)
+        if wheel.next_due(limit) != first:
+            errors.append(f'step {step}: next due {wheel.next_due(limit)}, expected {first}')
+        if len(errors) > 5:
+            break
+
+    return errors
+
+
+class RecordingOut:
+    def __init__(self):
+        self.sent = []
+
+    def send_messages(self, messages):
+        self.sent.extend(messages)
+
+
+def check_note_manager(seed):
+    """
+    each event's message is unique so what went out can be matched to what was added
+    """
+    rng = random.Random(seed)
+    manager = NoteManager()
+    midiout = RecordingOut()
+    pending = {} # message: (tick, channel, note, owner)
+    errors = []
+    tick = 0
+    for step in range(STEPS):
+        r = rng.random()
+        channel = rng.randint(0, 1)
+        note = rng.randint(0, 3)
+        if r < 0.6:
+            owner = rng.choice(('a', 'b', None))
+            due = tick + rng.randint(-2, 300)
+            message = ((0x90 | channel) << 16) | (note << 8) | (step % 128)
+            message |= step << 24 # unique
+            manager.add(due, message, owner)
+            pending[message] = (due, channel, note, owner)
+        elif r < 0.7:
+            cancelled = sorted(event.message for event in manager.cancel_note(channel, note))
+            expected = sorted(m for m, v in pending.items() if v[1] == channel and v[2] == note)
+            if cancelled != expected:
+                errors.append(f'step {step}: cancel_note got {len(cancelled)}, expected {len(expected)}')
+            for message in expected:
+                del pending[message]
+        elif r < 0.72:
+            owner = rng.choice(('a', 'b'))
+            cancelled = sorted(event.message for event in manager.cancel_owner(owner))
+            expected = sorted(m for m, v in pending.items() if v[3] == owner)
+            if cancelled != expected:
+                errors.append(f'step {step}: cancel_owner got {len(cancelled)}, expected {len(expected)}')
+            for message in expected:
+                del pending[message]
+        else:
+            tick += 1
+            start = len(midiout.sent)
+            manager.run(tick, midiout)
+            sent = midiout.sent[start:]
+            expected = [m for m, v in pending.items() if v[0] <= tick]
+            if sorted(sent) != sorted(expected):
+                errors.append(f'tick {tick}: sent {len(sent)}, expected {len(expected)}')
+            if [pending[m][0] for m in sent] != sorted(pending[m][0] for m in sent):
+                errors.append(f'tick {tick}: sent out of tick order')
+            for message in expected:
+                del pending[message]
+
+        if manager.get_stats()['pending'] != len(pending):
+            errors.append(f'step {step}: {manager.get_stats()["pending"]} pending, expected {len(pending)}')
+        if len(errors) > 5:
+            break
+
+    return errors
+
+ok = True
+for seed in SEEDS:
+    for start in STARTS:
+        errors = check_wheel(seed, start)
+        for error in errors:
+            print(f'wheel seed {seed} start {start} {error}')
+        ok = ok and not errors
+
+    errors = check_note_manager(seed)
+    for error in errors:
+        print(f'note manager seed {seed} {error}')
+    ok = ok and not errors
+
+print('OK' if ok else 'FAILED')
+sys.exit(0 if ok else 1)
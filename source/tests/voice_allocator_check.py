@@ -0,0 +1,138 @@
+"""
+ Copyright (C) 2020 Brian R. Gunnison
+
+ This file checks the voice allocator, random played and generated notes from a few seeds
+ under each stealing rule. What comes out must stay under the limits, steal the note
+ the rule says, and pair every note off with a sounding note. Runs without rtmidi
+
+ This file can not be copied and/or distributed without the express
+ permission of Brian R. Gunnison
+"""
+import sys
+import os
+import random
+import logging
+
+
+logging.basicConfig(level=logging.ERROR)
+log = logging.getLogger(__name__)
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from common.midi_messages import (VoiceAllocator, VOICE_STEALING, VOICE_GENERATED, VOICE_PLAYED, NOTE_ON, NOTE_OFF,
+                                  pack_message)
+
+SEEDS = range(10)
+NOTES = 4000
+LIMITS = [(4, 0), (0, 2), (6, 3)] # max_voices, max_per_channel
+
+
+def rank(stealing, voice):
+    """
+    the rule as the docstring gives it, lowest goes first
+    """
+    seq, priority, velocity = voice
+    if stealing == 'oldest':
+        return (seq,)
+    if stealing == 'quietest':
+        return (velocity, seq)
+    return (priority, velocity, seq)
+
+
+def check(seed, stealing, max_voices, max_per_channel):
+    rng = random.Random(seed)
+    allocator = VoiceAllocator(max_voices, max_per_channel, stealing)
+    held = {} # (channel, note): note ons sent in still to get their off
+    sounding = {} # (channel, note): note ons out without their off, counted like MidiOutput does
+    errors = []
+
+    def emit(message):
+        key = ((message >> 16) & 0x0F, (message >> 8) & 0x7F)
+        if (message >> 16) & 0xF0 == NOTE_ON and message & 0x7F > 0:
+            sounding[key] = sounding.get(key, 0) + 1
+            return
+        if sounding.get(key, 0) == 0:
+            errors.append(f'note off for {key} that is not sounding')
+            return
+        sounding[key] -= 1
+        if sounding[key] == 0:
+            del sounding[key]
+
+    for seq in range(1, NOTES + 1):
+        if held and (rng.random() < 0.45 or seq == NOTES):
+            key = rng.choice(list(held))
+            held[key] -= 1
+            if held[key] == 0:
+                del held[key]
+            for message in allocator.process(pack_message(NOTE_OFF | key[0], key[1]), VOICE_GENERATED):
+                emit(message)
+            continue
+
+        key = (rng.randint(0, 2), rng.randint(60, 67))
+        priority = rng.choice((VOICE_GENERATED, VOICE_PLAYED))
+        velocity = rng.randint(1, 127)
+        held[key] = held.get(key, 0) + 1
+        # what the rule should do with the voices as the allocator has them, seq is its own count
+        voices = {k: list(voice) for k, voice in allocator.voices.items()}
+        new_voice = [allocator.seq + 1, priority, velocity]
+        expected = []
+        refused = False
+        if key not in voices:
+            while True:
+                if max_per_channel and sum(1 for k in voices if k[0] == key[0]) >= max_per_channel:
+                    candidates = [k for k in voices if k[0] == key[0]]
+                elif max_voices and len(voices) >= max_voices:
+                    candidates = list(voices)
+                else:
+                    break
+                victim = min(candidates, key=lambda k: rank(stealing, voices[k]))
+                if stealing == 'priority' and rank(stealing, new_voice) < rank(stealing, voices[victim]):
+                    refused = True
+                    break
+                # one off for each note on it had, a retriggered note was counted twice
+                expected.extend([pack_message(NOTE_OFF | victim[0], victim[1])] * allocator.held[victim])
+                del voices[victim]
+        if refused == False:
+            expected.append(pack_message(NOTE_ON | key[0], key[1], velocity))
+
+        out = allocator.process(pack_message(NOTE_ON | key[0], key[1], velocity), priority)
+        if out != expected:
+            errors.append(f'note {seq} {key}: sent {[hex(m) for m in out]}, expected {[hex(m) for m in expected]}')
+
+        for message in out:
+            emit(message)
+
+        if max_voices and len(sounding) > max_voices:
+            errors.append(f'note {seq}: {len(sounding)} sounding over {max_voices}')
+        for channel in range(3):
+            count = sum(1 for k in sounding if k[0] == channel)
+            if max_per_channel and count > max_per_channel:
+                errors.append(f'note {seq}: {count} sounding on channel {channel} over {max_per_channel}')
+        if len(errors) > 5:
+            break
+
+    for key, count in held.items():
+        for n in range(count):
+            for message in allocator.process(pack_message(NOTE_OFF | key[0], key[1]), VOICE_GENERATED):
+                emit(message)
+    if sounding:
+        errors.append(f'left sounding after every note off: {sorted(sounding)}')
+    stats = allocator.get_stats()
+    if stats['sounding'] != 0 or allocator.swallow or allocator.held:
+        errors.append(f'allocator not empty after every note off: {stats}')
+    return errors, stats
+
+ok = True
+for stealing in VOICE_STEALING:
+    for max_voices, max_per_channel in LIMITS:
+        steals = 0
+        refused = 0
+        for seed in SEEDS:
+            errors, stats = check(seed, stealing, max_voices, max_per_channel)
+            steals += stats['steals']
+            refused += stats['refused']
+            for error in errors:
+                print(f'{stealing} {max_voices}/{max_per_channel} seed {seed} {error}')
+            ok = ok and not errors
+        print(f'{stealing:8} voices {max_voices} per channel {max_per_channel}: {steals} steals, {refused} refused')
+print('OK' if ok else 'FAILED')
+sys.exit(0 if ok else 1)
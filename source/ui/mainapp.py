@@ -25,6 +25,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from midiapps.midi_effect_manager import MidiEffectManager
 from common.midi import MidiManager, MidiConstants
 from common.upper_class_utils import Settings
+from common.timing import get_realtime_report
 
 import kivy
 kivy.require('1.11.1')
@@ -558,8 +559,7 @@ class RootWidget(BoxLayout):
             self.ids.clock_bpm_slider.disabled = True
             source = 'external'
 
-        self.effect.panic() # should do this in midi_manager, but it does not have effect. 
-
+        # no panic, the new source carries on the same tick count so pending echoes keep their place
         self.midi_manager.set_clock_source(source)
 
         bpm = self.midi_manager.clock.get_bpm()
@@ -600,8 +600,13 @@ class RootWidget(BoxLayout):
 
         self.midi_manager.register_midiin_activity_callback(self.midi_in_activity)
         self.midi_manager.register_midiout_activity_callback(self.midi_out_activity)
+        # midi threads set their priority when they start so keep the report current
+        Clock.schedule_interval(self.update_realtime_status, 2.0)
         log.info('Started activity LEDs')
 
+    def update_realtime_status(self, dt):
+        self.ids.realtime_status.text = get_realtime_report()
+
     def midi_in_activity(self):
         Clock.schedule_once(self.update_midi_in_LED)
         Clock.schedule_once(self.update_midi_in_LED, 0.2)